@@ -17,6 +17,12 @@ import llm_module # module for the LLM
 
 import chat_database # module for the chat database
 import docs_processor # module for processing docs
+import docs_index # module for retrieving relevant document chunks
+import docs_cache # module for caching extracted document text
+import broadcaster # module for sending to many chats within Telegram's rate limits
+import history_window # module for token-budgeted chat history
+import write_buffer # module for batching database writes
+import job_store # module for persisting scheduled jobs without blocking the event loop
 
 from datetime import datetime
 
@@ -25,10 +31,14 @@ from telegramify_markdown.customize import markdown_symbol
 from telegramify_markdown.interpreters import BaseInterpreter, MermaidInterpreter
 from telegramify_markdown.type import ContentTypes
 import csv
+import io
 import re
+import time
+import tempfile
+import httpx
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from random import randint
+from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime, timedelta
 import sys
 
@@ -42,12 +52,47 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-chat_db = chat_database.Chat_DB()
-llm = llm_module.LLM(Chat_Database=chat_db)
-docs_process = docs_processor.Docs_processor()
-scheduler = AsyncIOScheduler()
+# Created in main(): parser processes are spawned and re-import this script as __mp_main__, so
+# nothing at module level may open a database, index or scheduler
+chat_db = None
+llm = None
+docs_process = None
+docs_retriever = None
+extraction_cache = None
+broadcast_engine = None
+poll_details_buffer = None # poll_details documents are inserted in batches while a quiz fans out
+poll_answer_buffer = None # Poll answers are written behind in batches
+scheduler = None
+scheduler_store = None
+resume_task = None
 
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB limit
+DOWNLOAD_SPILL_SIZE = int(os.environ.get("DOWNLOAD_SPILL_SIZE", 5 * 1024 * 1024))  # Larger files are downloaded to disk
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "true").lower() == "true"  # Stream teaching replies
+DAILY_COHORTS = int(os.environ.get("DAILY_COHORTS", 6))  # Groups of users whose daily starters run at different times
+DAILY_WINDOW_START = 8  # Daily starters are sent between 8 AM
+DAILY_WINDOW_END = 21  # and 9 PM
+DAILY_LLM_CONCURRENCY = int(os.environ.get("DAILY_LLM_CONCURRENCY", 8))  # Daily starters generated at once
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))  # Seconds between streamed message edits
+TELEGRAM_MESSAGE_LIMIT = 4096
+POLL_ANSWER_BATCH = int(os.environ.get("POLL_ANSWER_BATCH", 200))  # Poll answers written per batch
+POLL_ANSWER_FLUSH_INTERVAL = float(os.environ.get("POLL_ANSWER_FLUSH_INTERVAL", 2.0))  # Seconds an answer may wait in the buffer
+ANALYSE_ALL_CONCURRENCY = int(os.environ.get("ANALYSE_ALL_CONCURRENCY", 8))  # Users analysed at once by /analyse_all
+ANALYSE_ALL_PROGRESS_INTERVAL = 5  # Seconds between edits of the /analyse_all progress message
+ANALYSE_ALL_CHECKPOINT_BATCH = 10  # Completed users buffered before the checkpoint is saved
+ANALYSE_ALL_RUN_ID = "analyse_all"
+
+async def write_poll_answers(documents):
+    # Details of the answered polls must be stored before they can be removed
+    if not await poll_details_buffer.flush():
+        raise RuntimeError("poll details are not stored yet")
+    await chat_db.store_poll_answers(documents)
+
+async def flush_write_buffers(application = None):
+    # Called on shutdown so that no buffered poll details, answers or scheduled job changes are lost
+    await poll_details_buffer.flush()
+    await poll_answer_buffer.flush()
+    await scheduler_store.flush()
 
 supported_file_types = [
     "pdf", "docx", "json", "html", "htm", "xml", "xlsx", "xls", "ipynb", "pptx",
@@ -121,16 +166,46 @@ ILS_QUESTIONS = [
     {"question": "44. When solving problems in a group, I would be more likely to", "options": ["think of the steps in the solution process.", "think of possible consequences or applications of the solution in a wide range of areas."]}
 ]
 
-def get_next_run_time():
-    now = datetime.now()
-    # Calculate the date for the next day
-    next_day = now + timedelta(days=1)
-    # Select a random hour between 8 (8 AM) and 21 (9 PM)
-    hour = randint(8, 21)
-    minute = randint(0, 59)
-    second = randint(0, 59)
-    next_run = next_day.replace(hour=hour, minute=minute, second=second, microsecond=0)
-    return next_run
+def daily_job_id(cohort: int):
+    return f"daily_initiation_task_{cohort}"
+
+def daily_trigger(cohort: int):
+    # The 8 AM - 9 PM window is split into DAILY_COHORTS equal slots; each day the cohort runs at a
+    # random time within its own slot, so load is spread evenly across the day
+    slot_minutes = (DAILY_WINDOW_END - DAILY_WINDOW_START) * 60 // DAILY_COHORTS
+    start = DAILY_WINDOW_START * 60 + cohort * slot_minutes
+    return CronTrigger(hour=start // 60, minute=start % 60, jitter=slot_minutes * 60)
+
+def schedule_daily_initiations():
+    # Add the cohort jobs that are not already in the job store; existing jobs keep their next run time
+    for cohort in range(DAILY_COHORTS):
+        trigger = daily_trigger(cohort)
+        job = scheduler.get_job(daily_job_id(cohort))
+        if job and repr(job.trigger) == repr(trigger):
+            continue
+
+        scheduler.add_job(
+            daily_initiation_task,
+            trigger,
+            args=[cohort],
+            id=daily_job_id(cohort),
+            replace_existing=True,
+            coalesce=True,
+            misfire_grace_time=3600  # Still run if the bot was down at the scheduled time
+        )
+
+    # Drop cohorts left over from a larger DAILY_COHORTS
+    for job in scheduler.get_jobs():
+        if job.id.startswith("daily_initiation_task_") and int(job.id.rsplit("_", 1)[1]) >= DAILY_COHORTS:
+            job.remove()
+
+def get_next_run_times():
+    next_runs = {}
+    for cohort in range(DAILY_COHORTS):
+        job = scheduler.get_job(daily_job_id(cohort))
+        if job:
+            next_runs[cohort] = job.next_run_time
+    return next_runs
 
 # Set command menu
 async def set_command_menu(bot):
@@ -153,7 +228,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"User {telegram_handle} (ID {user_id}) invoked /start.")
 
     # Check if user is already authenticated
-    if chat_db.is_user_authenticated(user_id=user_id):
+    if await chat_db.is_user_authenticated(user_id=user_id):
         await context.bot.send_message(chat_id=user_id, text=start_message, parse_mode="Markdown")
     else:
         # New user: start ILS questionnaire
@@ -168,19 +243,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
         # Clear any existing ILS answers and initialize state
-        chat_db.clear_ils_answers(user_id)
+        await chat_db.clear_ils_answers(user_id)
         context.user_data["ils_index"] = 0  # Start at question 0
         context.user_data["poll_map"] = {}  # To map poll IDs to question indices
         await send_ils_poll(update, context)
 
 
 # Handler for /new command to start a new conversation
+async def update_misconceptions(user_id: int):
+    # Background job: fold the conversation that just ended into the stored misconceptions
+    try:
+        await llm.update_misconceptions(user_id=user_id)
+    except Exception as e:
+        logging.error(f"Error updating misconceptions for user {user_id}: {e}")
+
 async def new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
     
-    context.user_data['documents'] = [] # Clear documents
+    await asyncio.to_thread(docs_retriever.clear, user_id) # Clear documents
+    # Analyse the previous conversation for misconceptions without delaying the reply
+    context.application.create_task(update_misconceptions(user_id), update=update)
     # Start a new conversation
-    convo_id = chat_db.start_new_conversation(user_id=user_id, message="A new conversation has started.")
+    convo_id = await chat_db.start_new_conversation(user_id=user_id, message="A new conversation has started.")
     logging.info(f"New conversation started for user {user_id}.")
     # context.user_data['conversation_id'] = convo_id # Storing conversation id
 
@@ -199,12 +283,9 @@ async def new(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clear_documents(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
-    # Reset the documents list if it exists
-    if 'documents' in context.user_data:
-        context.user_data['documents'] = []
-        logging.info(f"Cleared processed documents for user {user_id}.")
-    else:
-        logging.info(f"No documents to clear for user {user_id}.")
+    # Drop the user's document index
+    await asyncio.to_thread(docs_retriever.clear, user_id)
+    logging.info(f"Cleared processed documents for user {user_id}.")
     
     await context.bot.send_message(chat_id=user_id, text="All processed documents have been cleared.")
 
@@ -215,7 +296,7 @@ async def analyse(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_message = user_id if len(context.args) == 0 else context.args[0]
 
-    if chat_db.is_admin(user_id=user_id) and chat_db.user_exist(user_id=user_id):
+    if await chat_db.is_admin(user_id=user_id) and await chat_db.user_exist(user_id=user_id):
 
         logging.info(f"Analysing: {user_message}")
 
@@ -225,7 +306,7 @@ async def analyse(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await reply_to_query(update=update, context=context, user_id=user_id, response=response)
 
-    elif user_id == user_message and chat_db.user_exist(user_id=user_id):
+    elif user_id == user_message and await chat_db.user_exist(user_id=user_id):
 
         logging.info(f"Analysing: {user_message}")
 
@@ -240,7 +321,7 @@ async def analyse(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=user_id, text="User is unauthorised")
 
 async def reply_to_query_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id : str, response : str,
-                         prompt : str, conversation_id : int):
+                         prompt : str, conversation_id : int, stream_message = None):
 
     boxs = await telegramify_markdown.telegramify(
         content=response,
@@ -253,13 +334,18 @@ async def reply_to_query_feedback(update: Update, context: ContextTypes.DEFAULT_
     for item in boxs:
 
         try:
-            if item != boxs[-1]:
+            if stream_message is not None and item == boxs[0] and item != boxs[-1]:
+
+                # Replace the streamed plain-text preview with the rendered first part
+                await stream_message.edit_text(text=item.content, parse_mode="MarkdownV2")
+
+            elif item != boxs[-1]:
             
                 await context.bot.send_message(chat_id=user_id, text=item.content, parse_mode="MarkdownV2")
             
             else:
 
-                object_id = chat_db.input_callback_data(
+                object_id = await chat_db.input_callback_data(
                             prompt=prompt,
                             response=response,
                             conversation_id=conversation_id,
@@ -276,7 +362,10 @@ async def reply_to_query_feedback(update: Update, context: ContextTypes.DEFAULT_
                 
                 reply_markup = InlineKeyboardMarkup(keyboard)
 
-                await context.bot.send_message(chat_id=user_id, text=item.content, parse_mode="MarkdownV2", reply_markup=reply_markup)
+                if stream_message is not None and item == boxs[0]:
+                    await stream_message.edit_text(text=item.content, parse_mode="MarkdownV2", reply_markup=reply_markup)
+                else:
+                    await context.bot.send_message(chat_id=user_id, text=item.content, parse_mode="MarkdownV2", reply_markup=reply_markup)
                 
 
             
@@ -284,6 +373,40 @@ async def reply_to_query_feedback(update: Update, context: ContextTypes.DEFAULT_
             logging.error(f"Error sending part of the message: {send_error}\n\nMessage : {item}")
             await context.bot.send_message(chat_id=user_id, text="Error: Sending Message")
 
+async def stream_to_message(context: ContextTypes.DEFAULT_TYPE, user_id : str, stream):
+    """
+    Shows a streamed answer as it is generated: the first chunk is sent as a plain-text message
+    which is then edited at most once every STREAM_EDIT_INTERVAL seconds.
+    Returns the preview message (None if nothing was streamed) and the complete answer.
+    """
+    chunks = []
+    stream_message = None
+    last_edit = 0.0
+    shown = ""
+
+    async for chunk in stream:
+        chunks.append(chunk)
+
+        if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+
+        preview = "".join(chunks)[:TELEGRAM_MESSAGE_LIMIT]
+        if not preview.strip() or preview == shown:
+            continue
+
+        try:
+            if stream_message is None:
+                stream_message = await context.bot.send_message(chat_id=user_id, text=preview)
+            else:
+                await stream_message.edit_text(text=preview)
+            shown = preview
+        except Exception as edit_error:
+            logging.warning(f"Error updating streamed message for user {user_id}: {edit_error}")
+
+        last_edit = time.monotonic()
+
+    return stream_message, "".join(chunks)
+
 async def reply_to_daily(app, user_id: str, response: str):
 
     boxs = await telegramify_markdown.telegramify(
@@ -301,6 +424,7 @@ async def reply_to_daily(app, user_id: str, response: str):
             
         except Exception as send_error:
             logging.error(f"Error daily message: {send_error}\n\nMessage : {item}")
+            raise # Let the caller count the delivery as failed
 
     logging.info(f"Message sent to user {user_id}: {response}")
 
@@ -335,7 +459,7 @@ async def misconception(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_message = user_id if len(context.args) == 0 else context.args[0].upper()
 
-    if chat_db.is_admin(user_id=user_id) and chat_db.user_exist(user_id=user_id):
+    if await chat_db.is_admin(user_id=user_id) and await chat_db.user_exist(user_id=user_id):
 
         logging.info(f"Misconception: {user_message}")
 
@@ -352,7 +476,7 @@ async def misconception(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await reply_to_query(update=update, context=context, user_id=user_id, response=response)
 
-    elif user_id == user_message and chat_db.user_exist(user_id=user_id):
+    elif user_id == user_message and await chat_db.user_exist(user_id=user_id):
 
         logging.info(f"Misconception: {user_message}")
 
@@ -389,82 +513,158 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         case "like":
             object_id = metadata_parts[1]
-            prompt, response, conversation_id = chat_db.get_callback_data(object_id)
-            object_id = chat_db.input_feedback_data(user_id=user_id, prompt=prompt, response=response, 
+            prompt, response, conversation_id = await chat_db.get_callback_data(object_id)
+            object_id = await chat_db.input_feedback_data(user_id=user_id, prompt=prompt, response=response, 
                                                      conversation_id=conversation_id, sentiment=category)
             await context.bot.send_message(chat_id=user_id, text="Thank you so much for your feedback! 😊")
 
         case "dislike":
             object_id = metadata_parts[1]
-            prompt, response, conversation_id = chat_db.get_callback_data(object_id)
-            object_id = chat_db.input_feedback_data(user_id=user_id, prompt=prompt, response=response, 
+            prompt, response, conversation_id = await chat_db.get_callback_data(object_id)
+            object_id = await chat_db.input_feedback_data(user_id=user_id, prompt=prompt, response=response, 
                                                      conversation_id=conversation_id, sentiment=category)
             await context.bot.send_message(chat_id=user_id, text="Thank you so much for your feedback! 😊")
 
 # Handler for handling teach feedback export
-async def export_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /export command to export the feedback collection."""
-    user_id = update.effective_chat.id
-    file_path = f"feedback_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
+EXPORT_USAGE = (
+    "Optional filters, as key=value arguments:\n"
+    "from=YYYY-MM-DD  to=YYYY-MM-DD (inclusive)\n"
+    "users=<id>,<id>,...\n"
+    "poll=<poll number> (/export_poll only)\n"
+    "sentiment=<value> (/export_feedback only)\n"
+    "fields=<field>,<field>,... (columns to export)\n"
+    "format=csv|parquet (parquet for /export_chat and /export_poll)"
+)
 
-    try:
-        # Check if the user is an admin
-        if not chat_db.is_admin(user_id=user_id):
-            await context.bot.send_message(chat_id=user_id, text="Unauthorized access. This command is for admins only.")
-            return
+EXPORT_EXTENSIONS = {"csv": "csv.gz", "parquet": "parquet"}
+
+def parse_export_args(args: list):
+    # Turns ["from=2025-01-01", "users=1,2", ...] into (filters, fields, format) for the Async_Chat_DB export methods
+    filters = {}
+    fields = None
+    export_format = "csv"
+    for arg in args:
+        key, separator, value = arg.partition("=")
+        if not separator or not value:
+            raise ValueError(f"Expected key=value, got '{arg}'")
+
+        key = key.lower()
+        if key == "from":
+            filters["date_from"] = datetime.strptime(value, "%Y-%m-%d")
+        elif key == "to":
+            filters["date_to"] = datetime.strptime(value, "%Y-%m-%d") + timedelta(days=1)
+        elif key == "users":
+            filters["user_ids"] = [int(user_id) for user_id in value.split(",") if user_id]
+        elif key == "poll":
+            filters["poll_number"] = int(value)
+        elif key == "sentiment":
+            filters["sentiment"] = value
+        elif key == "fields":
+            fields = [field for field in value.split(",") if field]
+        elif key == "format":
+            export_format = value.lower()
+            if export_format not in EXPORT_EXTENSIONS:
+                raise ValueError(f"Unknown format '{value}'")
+        else:
+            raise ValueError(f"Unknown filter '{key}'")
+
+    return filters, fields, export_format
+
+async def send_document_stream(bot, chat_id: int, document, file_name: str):
+    """
+    Uploads an open file to a chat with sendDocument, streaming it from the file object.
+    InputFile would read the whole file into memory first.
+    """
+    # Generous timeouts: a 50 MB upload can take a while on a slow link
+    timeout = httpx.Timeout(30.0, write=300.0, read=300.0)
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        response = await client.post(f"{bot.base_url}/sendDocument",
+                                     data={"chat_id": str(chat_id)},
+                                     files={"document": (file_name, document)})
+    result = response.json()
+    if not result.get("ok"):
+        raise RuntimeError(f"sendDocument failed: {result.get('description', response.status_code)}")
+
+async def send_export(update: Update, context: ContextTypes.DEFAULT_TYPE, exports: dict, file_prefix: str, label: str):
+    """
+    Runs an admin-only export and sends the result as a gzip-compressed CSV or a Parquet file.
+    exports maps each supported format to a coroutine function taking filters and fields and
+    returning a rewound file object, which is closed here.
+    """
+    user_id = update.effective_chat.id
 
-        # Export the teach feedback collection to a CSV file
-        chat_db.export_feedback_collection_to_csv(file_path)
+    # Check if the user is an admin
+    if not await chat_db.is_admin(user_id=user_id):
+        await context.bot.send_message(chat_id=user_id, text="Unauthorized access. This command is for admins only.")
+        return
 
-        # Send the file to the admin
-        with open(file_path, 'rb') as document:
-            await context.bot.send_document(chat_id=user_id, document=document)
+    export_file = None
+    filters = {}
+    try:
+        # Filters run as indexed queries, so only the requested slice is read
+        filters, fields, export_format = parse_export_args(context.args or [])
+        if export_format not in exports:
+            raise ValueError(f"The {export_format} format is not available for this export")
+        export_file = await exports[export_format](filters=filters, fields=fields)
+
+        # The export stops early past the limit, but check the finished file too before uploading it
+        size = export_file.seek(0, io.SEEK_END)
+        export_file.seek(0)
+        if size > chat_database.EXPORT_MAX_BYTES:
+            raise chat_database.Export_too_large(chat_database.EXPORT_MAX_BYTES)
+
+        # Stream the compressed export straight from its buffer; nothing is written next to the bot
+        file_name = f"{file_prefix}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.{EXPORT_EXTENSIONS[export_format]}"
+        await send_document_stream(context.bot, user_id, export_file, file_name)
+    except chat_database.Empty_export as e:
+        # An empty slice is a normal result, not a failed export
+        await context.bot.send_message(chat_id=user_id, text="No documents match these filters." if filters else str(e))
+    except chat_database.Export_too_large as e:
+        await context.bot.send_message(chat_id=user_id, text=f"{e}\n\n{EXPORT_USAGE}")
+    except ValueError as e:
+        await context.bot.send_message(chat_id=user_id, text=f"{e}\n\n{EXPORT_USAGE}")
     except Exception as e:
-        logging.error(f"Error exporting feedback collection: {e}")
-        await context.bot.send_message(chat_id=user_id, text="Failed to export feedback collection.")
+        logging.error(f"Error exporting {label}: {e}")
+        await context.bot.send_message(chat_id=user_id, text=f"Failed to export {label}.")
     finally:
-        # Ensure the file is deleted after being sent
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as delete_error:
-                logging.error(f"Error deleting file {file_path}: {delete_error}")
+        if export_file:
+            export_file.close()
+
+async def export_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /export command to export the feedback collection."""
+    await send_export(update, context, {"csv": chat_db.export_feedback_collection_to_csv}, "feedback", "feedback collection")
 
 # Handler for handling chat history export
 async def export_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /export_chat command to export the chat collection."""
-    user_id = update.effective_chat.id
-    file_path = f"chat_history_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-
+    await send_export(update, context, {
+        "csv": chat_db.export_chat_collection_to_csv,
+        "parquet": chat_db.export_chat_collection_to_parquet,
+    }, "chat_history", "chat collection")
+
+async def download_attachment(file, file_size: int, suffix: str = ""):
+    """
+    Downloads a Telegram file into memory and returns its bytes. Files above DOWNLOAD_SPILL_SIZE are
+    written to a uniquely named temp file in FILE_DRIVE instead, and its path is returned; the
+    caller removes it.
+    """
+    if file_size is not None and file_size <= DOWNLOAD_SPILL_SIZE:
+        buffer = io.BytesIO()
+        await file.download_to_memory(out=buffer)
+        return buffer.getvalue()
+
+    fd, file_path = tempfile.mkstemp(dir=FILE_DRIVE, suffix=suffix)
+    os.close(fd)
     try:
-        # Check if the user is an admin
-        if not chat_db.is_admin(user_id=user_id):
-            await context.bot.send_message(chat_id=user_id, text="Unauthorized access. This command is for admins only.")
-            return
-
-        # Export the chat collection to a CSV file
-        chat_db.export_chat_collection_to_csv(file_path)
-
-        # Send the file to the admin
-        with open(file_path, 'rb') as document:
-            await context.bot.send_document(chat_id=user_id, document=document)
-    except Exception as e:
-        logging.error(f"Error exporting chat collection: {e}")
-        await context.bot.send_message(chat_id=user_id, text="Failed to export chat collection.")
-    finally:
-        # Ensure the file is deleted after being sent
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as delete_error:
-                logging.error(f"Error deleting file {file_path}: {delete_error}")
+        await file.download_to_drive(custom_path=file_path)
+    except Exception:
+        os.remove(file_path)
+        raise
+    return file_path
 
 # Handler to capture the user's attachments
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
-    # Ensure a documents list exists in user_data
-    if 'documents' not in context.user_data:
-        context.user_data['documents'] = []
 
     if update.message.document:
         document = update.message.document
@@ -481,53 +681,52 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        # 2. Download the document using download_to_drive (saves file to disk)
-        try:
-            file = await update.message.effective_attachment.get_file()
-            file_path = await file.download_to_drive(custom_path=os.path.join(FILE_DRIVE, file_name))
-            logging.info(f"File downloaded to: {file_path}")
-        except Exception as e:
-            logging.error(f"Error downloading file: {e}")
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="Failed to download the document. Please try again."
-            )
-            return
-
-        # 3. Determine file type from its extension
-        try:
-            _, file_extension = os.path.splitext(file_path)
-            file_type = file_extension.lstrip('.').lower()
-        except Exception as e:
-            logging.error(f"Error extracting file type: {e}")
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="Failed to determine the file type. Please check the file and try again."
-            )
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            return
+        # 2. Determine file type from its extension
+        _, file_extension = os.path.splitext(file_name or "")
+        file_type = file_extension.lstrip('.').lower()
 
-        # 4. Check if file type is supported; if not, inform user and remove file
+        # 3. Check if file type is supported before downloading anything
         if file_type not in supported_file_types:
             await context.bot.send_message(
                 chat_id=user_id,
                 text=unsupported_file_message,
                 parse_mode="Markdown"
             )
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    logging.info(f"Removed unsupported file: {file_path}")
-                except Exception as e:
-                    logging.error(f"Error removing file: {file_path}. {e}")
             return
 
-        # 5. Process the document
+        file_path = None
         try:
-            text = docs_process.load_document(file_path=file_path, file_type=file_type)
-            logging.info(f"Processed {file_name}: {text}")
-            context.user_data['documents'].append(f'{file_name}:\n{text}\n\n')
+            # 4. A file Telegram has seen before is served from the cache without download or parse
+            pages = await asyncio.to_thread(extraction_cache.get_by_file_id, document.file_unique_id)
+
+            if pages is None:
+                # 5. Download the document into memory (large files spill to a temp file)
+                try:
+                    file = await update.message.effective_attachment.get_file()
+                    source = await download_attachment(file, file_size, suffix=file_extension)
+                    if isinstance(source, str):
+                        file_path = source
+                        logging.info(f"File downloaded to: {file_path}")
+                except Exception as e:
+                    logging.error(f"Error downloading file: {e}")
+                    await context.bot.send_message(
+                        chat_id=user_id,
+                        text="Failed to download the document. Please try again."
+                    )
+                    return
+
+                # 6. Same content under another file id is still a cache hit; otherwise parse and cache it
+                digest = await asyncio.to_thread(extraction_cache.hash_file, source)
+                pages = await asyncio.to_thread(extraction_cache.get_by_hash, digest)
+                if pages is None:
+                    pages = await docs_process.aload_pages(file_path=source, file_type=file_type)
+                await asyncio.to_thread(extraction_cache.put, digest, pages, document.file_unique_id)
+            else:
+                logging.info(f"Cache hit for {file_name} ({document.file_unique_id})")
+
+            logging.info(f"Processed {file_name}: {len(pages)} page(s)")
+            # 7. Chunk and index the text; only the chunks relevant to each question reach the prompt
+            await asyncio.to_thread(docs_retriever.add_document, user_id, file_name, pages)
             await context.bot.send_message(
                 chat_id=user_id,
                 text=f"Document successfully processed: {file_name}"
@@ -539,8 +738,8 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text="Failed to process the document. Please try again later."
             )
         finally:
-            # 6. Remove the file from disk
-            if os.path.exists(file_path):
+            # 8. Remove the file from disk
+            if file_path and os.path.exists(file_path):
                 try:
                     os.remove(file_path)
                     logging.info(f"Removed file: {file_path}")
@@ -565,7 +764,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Retrieve most recent conversation ID
-        conversation_id = chat_db.get_recent_conversation(user_id=user_id)
+        conversation_id = await chat_db.get_recent_conversation(user_id=user_id)
     except Exception as convo_error:
         logging.error(f"Error retrieving recent conversation for user {user_id}: {convo_error}")
         await context.bot.send_message(chat_id=user_id, text="An error occurred while retrieving your conversation history. Please try again later.")
@@ -573,12 +772,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     else:
 
+        stream_message = None
+
         try:
             # Get response from LLM
-            user_context = "".join(context.user_data['documents']) if "documents" in context.user_data else ""
+            user_context = await asyncio.to_thread(docs_retriever.query, user_id, user_message)
 
-            response = await llm.response_message(message=user_message, user_id=user_id, conversation_id=conversation_id, 
-                                                         user_context = user_context)
+            if STREAM_RESPONSES:
+                stream = llm.stream_response_message(message=user_message, user_id=user_id, conversation_id=conversation_id,
+                                                     user_context = user_context)
+                stream_message, response = await stream_to_message(context=context, user_id=user_id, stream=stream)
+            else:
+                response = await llm.response_message(message=user_message, user_id=user_id, conversation_id=conversation_id, 
+                                                             user_context = user_context)
                     
 
         except Exception as llm_error:
@@ -586,10 +792,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await context.bot.send_message(chat_id=user_id, text="An error occurred while processing your message. Please try again later.")
             return
                 
+        # Final MarkdownV2 render and feedback keyboard, applied once the answer is complete
         await reply_to_query_feedback(update=update, context=context, user_id=user_id, response=response, 
-                                              prompt=user_message, conversation_id=conversation_id)
-        
-        context.user_data['documents'] = []
+                                              prompt=user_message, conversation_id=conversation_id, stream_message=stream_message)
 
 
 
@@ -615,33 +820,7 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logging.error(f"Failed to send error notification: {e}")
 
 async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_chat.id
-    # Create a filename with a timestamp
-    file_path = f"users_collection_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-    
-    try:
-        # Only allow admins to use this command
-        if not chat_db.is_admin(user_id=user_id):
-            await context.bot.send_message(chat_id=user_id, text="Unauthorized access. This command is for admins only.")
-            return
-
-        # Export the users collection to a CSV file using the method added in Chat_DB
-        chat_db.export_users_collection_to_csv(file_path)
-
-        # Open and send the file to the admin
-        with open(file_path, 'rb') as document:
-            await context.bot.send_document(chat_id=user_id, document=document)
-
-    except Exception as e:
-        logging.error(f"Error exporting users collection: {e}")
-        await context.bot.send_message(chat_id=user_id, text="Failed to export users collection.")
-    finally:
-        # Remove the file after sending
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as delete_error:
-                logging.error(f"Error deleting file {file_path}: {delete_error}")
+    await send_export(update, context, {"csv": chat_db.export_users_collection_to_csv}, "users_collection", "users collection")
 
 
 ##########################################################################################################################################
@@ -651,7 +830,7 @@ POLL_UPLOAD = 1
 # Start the poll upload conversation
 async def start_poll_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
-    if not chat_db.is_admin(user_id=user_id):
+    if not await chat_db.is_admin(user_id=user_id):
         await context.bot.send_message(chat_id=user_id, text="Unauthorized access. This command is for admins only.")
         return ConversationHandler.END
     await context.bot.send_message(
@@ -679,22 +858,23 @@ async def process_poll_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         file = await document.get_file()
-        file_path = os.path.join(FILE_DRIVE, file_name)
-        await file.download_to_drive(custom_path=file_path)
-        logging.info(f"CSV file downloaded: {file_path}")
+        source = await download_attachment(file, document.file_size, suffix=".csv")
+        file_path = source if isinstance(source, str) else None
+        logging.info(f"CSV file downloaded: {file_name}")
     except Exception as e:
         logging.error(f"Error downloading CSV file: {e}")
         await context.bot.send_message(chat_id=user_id, text="Failed to download the CSV file. Please try again.")
         return ConversationHandler.END
 
-    polls_sent = 0
-    poll_number = chat_db.get_latest_poll_number() + 1
+    questions = []
+    poll_number = await chat_db.get_latest_poll_number() + 1
 
-    student_ids = chat_db.get_all_students()
+    student_ids = await chat_db.get_all_students()
     recipients = student_ids + [user_id]
 
     try:
-        with open(file_path, newline='', encoding='utf-8') as csvfile:
+        csvfile = open(file_path, newline='', encoding='utf-8') if file_path else io.StringIO(source.decode('utf-8'), newline='')
+        with csvfile:
             reader = csv.reader(csvfile)
             # Skip header row
             next(reader, None)
@@ -713,39 +893,40 @@ async def process_poll_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     logging.warning(f"Row skipped (not enough valid options): {row}")
                     continue
 
-                for recipient in recipients:
-                    try:
-                        msg = await context.bot.send_poll(
-                            chat_id=recipient,
-                            question=question,
-                            options=valid_options,
-                            is_anonymous=False
-                        )
-                        polls_sent += 1
-                        poll = msg.poll
-                        chat_db.store_poll_details(
-                            poll_number=poll_number,
-                            poll_id=poll.id,
-                            question=question,
-                            options=valid_options
-                        )
-                    except Exception as poll_error:
-                        logging.error(f"Error sending poll to recipient {recipient}: {poll_error}")
-                        continue
+                questions.append({"question": question, "options": valid_options})
     except Exception as csv_error:
         logging.error(f"Error processing CSV file: {csv_error}")
         await context.bot.send_message(chat_id=user_id, text="Failed to process the CSV file.")
+        return ConversationHandler.END
     finally:
-        if os.path.exists(file_path):
+        if file_path and os.path.exists(file_path):
             try:
                 os.remove(file_path)
                 logging.info(f"Removed CSV file: {file_path}")
             except Exception as remove_error:
                 logging.error(f"Error removing CSV file: {remove_error}")
 
+    if not questions:
+        await context.bot.send_message(chat_id=user_id, text="No valid questions found in the CSV file.")
+        return ConversationHandler.END
+
+    # One broadcast for the whole quiz: recipients are served concurrently within the rate limits,
+    # and each recipient receives the questions in CSV order
+    job_id = f"poll-{poll_number}-{datetime.now():%Y%m%d%H%M%S}"
+    args = {"poll_number": poll_number, "questions": questions, "job_id": job_id}
+    summary = await broadcast_engine.broadcast(
+        recipients=recipients,
+        send=poll_sender(context.bot, **args),
+        job_id=job_id,
+        description=f"Poll {poll_number} ({len(questions)} question(s))",
+        payload={"kind": "poll", "args": args},
+    )
+    # Write the remaining poll_details before reporting back
+    await poll_details_buffer.flush()
+
     await context.bot.send_message(
         chat_id=user_id,
-        text=f"Poll upload complete. {polls_sent} poll(s) sent to {len(recipients)} recipient(s)."
+        text=f"Poll upload complete.\n{broadcaster.Broadcaster.format_summary(summary)}"
     )
     return ConversationHandler.END
 
@@ -772,7 +953,7 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return  # No answer selected
         # Retrieve the chosen option text from the ILS question list
         chosen_option = ILS_QUESTIONS[question_index]["options"][selected_options[0]]
-        chat_db.store_ils_answer(user_id, question_index, chosen_option)
+        await chat_db.store_ils_answer(user_id, question_index, chosen_option)
 
         # Advance to the next ILS question
         context.user_data["ils_index"] = question_index + 1
@@ -790,7 +971,7 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Otherwise, handle as a normal poll (for quizzes or other polls)
 
 
-        poll_details = chat_db.get_poll_details(poll_id)
+        poll_details = await chat_db.get_poll_details(poll_id)
         if poll_details is None:
             logging.error(f"No poll details found for poll_id {poll_id}")
             return
@@ -801,48 +982,25 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return  # No answer selected
         # Get the text corresponding to the selected option
         student_answer = options[selected_options[0]]
-        chat_db.store_poll_response(
+        # The response is stored and the poll details removed by the next batch write
+        await poll_answer_buffer.add(chat_db.poll_response_document(
             poll_number=poll_number,
             poll_id=poll_id,
             user_id=user_id,
             student_answer=student_answer,
             question=question,
             timestamp=datetime.now()
-        )
-        logging.info(f"Stored normal poll response from user {user_id} for poll {poll_id}: answer={student_answer}")
-
-        # Remove the poll details now that the response is stored
-        chat_db.remove_poll_details(poll_id)
+        ))
+        logging.info(f"Buffered normal poll response from user {user_id} for poll {poll_id}: answer={student_answer}")
 
 
 
 
 async def export_poll_responses(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_chat.id
-    file_path = f"quiz_responses_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-
-    try:
-        # Only allow admins to use this command.
-        if not chat_db.is_admin(user_id=user_id):
-            await context.bot.send_message(chat_id=user_id, text="Unauthorized access. This command is for admins only.")
-            return
-
-        # Export the quiz responses collection to a CSV file.
-        chat_db.export_poll_responses_collection_to_csv(file_path)
-
-        # Send the file to the admin.
-        with open(file_path, 'rb') as document:
-            await context.bot.send_document(chat_id=user_id, document=document)
-    except Exception as e:
-        logging.error(f"Error exporting quiz responses: {e}")
-        await context.bot.send_message(chat_id=user_id, text="Failed to export quiz responses.")
-    finally:
-        # Delete the file after sending.
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as delete_error:
-                logging.error(f"Error deleting file {file_path}: {delete_error}")
+    await send_export(update, context, {
+        "csv": chat_db.export_poll_responses_collection_to_csv,
+        "parquet": chat_db.export_poll_responses_collection_to_parquet,
+    }, "quiz_responses", "quiz responses")
 
 async def send_ils_poll(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id if update.effective_chat is not None else update.effective_user.id
@@ -868,7 +1026,7 @@ async def send_ils_poll(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def finalize_ils(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id if update.effective_chat is not None else update.effective_user.id
-    answers = chat_db.get_ils_answers(user_id)  # Retrieves a list of answers in order
+    answers = await chat_db.get_ils_answers(user_id)  # Retrieves a list of answers in order
 
     # Mapping each question index to a dimension:
     DIMENSION_MAP = {
@@ -924,7 +1082,7 @@ async def finalize_ils(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # Mark the user as authenticated
-    chat_db.authenticate_user(user_id)
+    await chat_db.authenticate_user(user_id)
 
     # Build a merged analysis dictionary
     ils_analysis = {
@@ -935,48 +1093,156 @@ async def finalize_ils(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
 
     # Update the user's record in the users collection with the merged analysis
-    chat_db.users_collection.update_one(
-        {"user_id": user_id},
-        {"$set": {"start_ils_analysis": ils_analysis}}
-    )
+    await chat_db.store_start_ils_analysis(user_id, ils_analysis)
 
     await context.bot.send_message(chat_id=user_id, text=final_message, parse_mode="Markdown")
 
     # Clean up ILS-related state
-    chat_db.clear_ils_answers(user_id)
+    await chat_db.clear_ils_answers(user_id)
     context.user_data.pop("ils_index", None)
     context.user_data.pop("poll_map", None)
 
-async def daily_initiation_task():
-    student_ids = chat_db.get_all_users()  # Retrieves list of user_ids for non-admin users
-    for user_id in student_ids:
-        try:
-            # Generate a conversation starter for the user based on their latest 10 messages
-            starter = await llm.starter_message(user_id=user_id)
-            # Send the generated message to the user; 'app' is your Application instance
+def announcement_sender(bot, text: str):
+    async def send(chat_id):
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode="Markdown")
+    return send
+
+def poll_sender(bot, poll_number: int, questions: list, job_id: str = None):
+    # Sends every question to a chat in order. The next question of each chat is saved with the
+    # broadcast, so a retry or a resumed job continues from the question that failed
+    next_question = None
+    loading = asyncio.Lock()
+
+    async def send(chat_id):
+        nonlocal next_question
+        async with loading:
+            if next_question == None:
+                next_question = await chat_db.get_broadcast_steps(job_id) if job_id else {}
+
+        start = next_question.get(chat_id, 0)
+        for index in range(start, len(questions)):
+            if index > start:
+                await broadcast_engine.throttle(chat_id)
+
+            question = questions[index]["question"]
+            options = questions[index]["options"]
+            msg = await bot.send_poll(
+                chat_id=chat_id,
+                question=question,
+                options=options,
+                is_anonymous=False
+            )
+            next_question[chat_id] = index + 1
+            details = chat_db.poll_details_document(
+                poll_number=poll_number,
+                poll_id=msg.poll.id,
+                question=question,
+                options=options
+            )
+            # Answers are matched from memory, before the buffered insert reaches the database
+            chat_db.cache_poll_details(details)
+            await poll_details_buffer.add(details)
+            if job_id:
+                await chat_db.mark_broadcast_step(job_id, chat_id, index + 1)
+    return send
+
+def daily_preparer(bot):
+    async def prepare(user_id):
+        # Generate a conversation starter for the user based on their latest 10 messages
+        return await llm.starter_message(user_id=user_id)
+    return prepare
+
+def daily_sender(bot):
+    async def send(user_id, starter):
+        await reply_to_daily(app=app, user_id=user_id, response=starter)
+        # Only record starters the user actually received
+        await chat_db.add_ai_message(message=starter, user_id=user_id)
+    return send
+
+# Rebuilds the send function of a broadcast from the payload stored with it
+BROADCAST_SENDERS = {
+    "announcement": announcement_sender,
+    "poll": poll_sender,
+    "daily": daily_sender,
+}
+
+# Broadcasts whose content is generated per chat before it is sent
+BROADCAST_PREPARERS = {
+    "daily": (daily_preparer, DAILY_LLM_CONCURRENCY),
+}
+
+async def resume_broadcasts(bot):
+    # Finish broadcasts that were interrupted by a restart, skipping chats that were already handled
+    for job in await chat_db.get_unfinished_broadcasts():
+        payload = job.get("payload") or {}
+        make_sender = BROADCAST_SENDERS.get(payload.get("kind"))
+        if make_sender == None:
+            logging.warning(f"Cannot resume broadcast {job['_id']}: unknown payload {payload}")
+            continue
 
-            chat_db.add_ai_message(message=starter, user_id=user_id)
+        prepare, prepare_concurrency = None, None
+        if payload.get("kind") in BROADCAST_PREPARERS:
+            make_preparer, prepare_concurrency = BROADCAST_PREPARERS[payload["kind"]]
+            prepare = make_preparer(bot, **payload.get("args", {}))
 
-            await reply_to_daily(app=app,user_id=user_id, response=starter)
+        logging.info(f"Resuming broadcast {job['_id']}")
+        try:
+            summary = await broadcast_engine.broadcast(
+                recipients=job["recipients"],
+                send=make_sender(bot, **payload.get("args", {})),
+                job_id=job["_id"],
+                description=job.get("description", "Broadcast"),
+                prepare=prepare,
+                prepare_concurrency=prepare_concurrency,
+            )
+            await poll_details_buffer.flush()
         except Exception as e:
-            logging.error(f"Error sending daily conversation starter to user {user_id}: {e}")
+            logging.error(f"Error resuming broadcast {job['_id']}: {e}")
+            continue
+        for admin_id in await chat_db.get_all_admins():
+            try:
+                await bot.send_message(chat_id=admin_id, text="Resumed. " + broadcaster.Broadcaster.format_summary(summary))
+            except Exception as e:
+                logging.error(f"Error sending resume summary to admin {admin_id}: {e}")
+
+async def daily_initiation_task(cohort: int = 0):
+    all_users = await chat_db.get_all_users()  # Retrieves list of user_ids for non-admin users
+    student_ids = [user_id for user_id in all_users if user_id % DAILY_COHORTS == cohort]
+
+    # Starters are generated with at most DAILY_LLM_CONCURRENCY LLM calls in flight, and each one is
+    # delivered as soon as it is ready while the rest are still being generated
+    summary = await broadcast_engine.broadcast(
+        recipients=student_ids,
+        send=daily_sender(app.bot),
+        job_id=f"daily-{datetime.now():%Y-%m-%d}-{cohort}",
+        description=f"Daily conversation starter (cohort {cohort + 1}/{DAILY_COHORTS})",
+        payload={"kind": "daily", "args": {}},
+        prepare=daily_preparer(app.bot),
+        prepare_concurrency=DAILY_LLM_CONCURRENCY,
+    )
 
-    # Schedule the next run at a random time between 8:00 AM and 9:00 PM
-    next_run = get_next_run_time()
-    scheduler.add_job(daily_initiation_task, 'date', run_date=next_run, id='daily_initiation_task')
-    logging.info(f"Next daily initiation scheduled for {next_run}")
+    # The cron trigger has already scheduled this cohort's next run
+    job = scheduler.get_job(daily_job_id(cohort))
+    next_runs = {cohort: job.next_run_time} if job else {}
+    logging.info(f"Next daily initiation for cohort {cohort} scheduled for {next_runs.get(cohort)}")
 
     # Notify admins about the next scheduled run
-    await notify_admins(next_run)
+    await notify_admins(next_runs, summary=summary)
+
+async def notify_admins(next_runs: dict, summary: dict = None):
+    text = "Daily interaction scheduled for:\n" + "\n".join(
+        f"Cohort {cohort + 1}: {next_run:%Y-%m-%d %H:%M}" for cohort, next_run in sorted(next_runs.items())
+    )
+    if summary:
+        text = broadcaster.Broadcaster.format_summary(summary) + "\n\n" + text
 
-async def notify_admins(next_run):
     # Get all admin user IDs from the database
-    admin_ids = chat_db.get_all_admins()  # Assuming this function exists as shown
+    admin_ids = await chat_db.get_all_admins()  # Assuming this function exists as shown
     for admin_id in admin_ids:
         try:
             await app.bot.send_message(
                 chat_id=admin_id,
-                text=f"Daily interaction scheduled for: {next_run}",
+                text=text,
                 parse_mode="Markdown"
             )
         except Exception as e:
@@ -986,7 +1252,7 @@ async def announce(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_id = update.effective_chat.id
     
     # Check if the user is an admin
-    if not chat_db.is_admin(user_id=admin_id):
+    if not await chat_db.is_admin(user_id=admin_id):
         await context.bot.send_message(chat_id=admin_id, text="Unauthorized: This command is for admins only.")
         return
 
@@ -1001,115 +1267,226 @@ async def announce(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     
     # Retrieve all users from the database
-    all_users = chat_db.get_all_users()
-    sent_count = 0
+    all_users = await chat_db.get_all_users()
+
+    # Send the announcement to every user concurrently, within Telegram's rate limits
+    summary = await broadcast_engine.broadcast(
+        recipients=all_users,
+        send=announcement_sender(context.bot, announcement),
+        job_id=f"announce-{datetime.now():%Y%m%d%H%M%S}-{admin_id}",
+        description="Announcement",
+        payload={"kind": "announcement", "args": {"text": announcement}},
+    )
 
-    # Loop over each user and send the announcement
-    for user in all_users:
-        try:
-            await context.bot.send_message(chat_id=user, text=announcement, parse_mode="Markdown")
-            sent_count += 1
-        except Exception as e:
-            logging.error(f"Failed to send announcement to user {user}: {e}")
-    
-    # Confirm to the admin that the announcement was sent
-    await context.bot.send_message(chat_id=admin_id, text=f"Announcement sent to {sent_count} users.")
+    # Confirm to the admin how the announcement was delivered
+    await context.bot.send_message(chat_id=admin_id, text=broadcaster.Broadcaster.format_summary(summary))
+
+# Regular expression to parse the expected report format.
+ILS_REPORT_PATTERN = re.compile(
+    r"Active/Reflective:\s*(.+?)\s+\(score:\s*(\d+)\).*?"
+    r"Sensing/Intuitive:\s*(.+?)\s+\(score:\s*(\d+)\).*?"
+    r"Visual/Verbal:\s*(.+?)\s+\(score:\s*(\d+)\).*?"
+    r"Sequential/Global:\s*(.+?)\s+\(score:\s*(\d+)\)",
+    re.DOTALL
+)
+
+def parse_ils_report(report: str):
+    # Returns the per-dimension styles and scores of an analyse_all report, or None if it does not match
+    match = ILS_REPORT_PATTERN.search(report)
+    if not match:
+        return None
+
+    dimensions = ["Active/Reflective", "Sensing/Intuitive", "Visual/Verbal", "Sequential/Global"]
+    return {
+        dimension: {"style": match.group(2 * i + 1).strip(), "score": int(match.group(2 * i + 2))}
+        for i, dimension in enumerate(dimensions)
+    }
+
+analyse_all_lock = asyncio.Lock() # Only one /analyse_all batch runs at a time
 
 async def analyse_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_id = update.effective_chat.id
-    if not chat_db.is_admin(user_id=admin_id):
+    if not await chat_db.is_admin(user_id=admin_id):
         await context.bot.send_message(chat_id=admin_id, text="Unauthorized: Only admins can use this command.")
         return
 
-    await context.bot.send_message(chat_id=admin_id, text="Starting comprehensive analysis for all users...")
-    user_ids = chat_db.get_all_users()
+    if analyse_all_lock.locked():
+        await context.bot.send_message(chat_id=admin_id, text="A comprehensive analysis is already running.")
+        return
 
+    async with analyse_all_lock:
+        await run_analyse_all(context.bot, admin_id)
+
+async def run_analyse_all(bot, admin_id: int):
+    user_ids = await chat_db.get_all_users()
+
+    # Users completed by an interrupted run are skipped
+    completed = await chat_db.start_analysis_run(ANALYSE_ALL_RUN_ID)
+    pending = [uid for uid in user_ids if uid not in completed]
+
+    counts = {"updated": 0, "no_history": 0, "unparsed": 0, "failed": 0}
+    failures = []
+    truncated_users = []
+    checkpoint = []
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(ANALYSE_ALL_CONCURRENCY)
+
+    def progress_text(done: bool = False):
+        processed = sum(counts.values())
+        text = (f"Comprehensive analysis {'complete' if done else 'in progress'}: {processed}/{len(pending)} users"
+                f" in {round(time.monotonic() - started)}s.\n"
+                f"Updated: {counts['updated']}\n"
+                f"No chat history: {counts['no_history']}\n"
+                f"Failed to parse: {counts['unparsed']}\n"
+                f"Failed: {counts['failed']}")
+        if truncated_users:
+            text += (f"\nHistory truncated: {len(truncated_users)} users had more than "
+                     f"{history_window.ANALYSIS_TOKEN_BUDGET} tokens of chat history; only their newest messages were analysed.")
+        if completed:
+            text += f"\nResumed run: {len(completed)} users were already analysed."
+        if done and failures:
+            text += "\n\nNot analysed (retried on the next /analyse_all):\n" + "\n".join(failures[:20])
+            if len(failures) > 20:
+                text += f"\n...and {len(failures) - 20} more."
+        return text
+
+    # One progress message, edited as the batch advances
+    progress_message = await bot.send_message(chat_id=admin_id, text=progress_text())
+    last_edit = time.monotonic()
+
+    async def save_checkpoint():
+        if checkpoint:
+            batch = checkpoint[:]
+            checkpoint.clear()
+            await chat_db.mark_analysis_completed(ANALYSE_ALL_RUN_ID, batch)
+
+    async def analyse_user(uid):
+        nonlocal last_edit
+        async with semaphore:
+            try:
+                # History is loaded once, within the analysis token budget, and handed to the analyser.
+                # No summary is involved: older turns are left out, and the report says for how many users
+                messages, _, truncated = await chat_db.get_recent_messages(
+                    user_id=uid,
+                    max_tokens=history_window.ANALYSIS_TOKEN_BUDGET,
+                    token_counter=llm.history.count_tokens,
+                )
+                if truncated:
+                    truncated_users.append(uid)
+                if not messages:
+                    status = "no_history"
+                else:
+                    report = await llm.analyse_all_message(user_id=uid, messages=messages)
+                    ils_analysis = parse_ils_report(report)
+
+                    if "No chat history available" in report:
+                        status = "no_history"
+                    elif ils_analysis == None:
+                        status = "unparsed"
+                    else:
+                        # Update the user's record with the merged analysis
+                        await chat_db.store_chat_ils_analysis(uid, ils_analysis)
+                        status = "updated"
+            except Exception as e:
+                logging.error(f"Analysis failed for user {uid}: {e}")
+                status = "failed"
+
+        counts[status] += 1
+        if status in ("unparsed", "failed"):
+            failures.append(f"User {uid}: {'failed to parse analysis report' if status == 'unparsed' else 'analysis failed'}")
+        else:
+            checkpoint.append(uid)
+            if len(checkpoint) >= ANALYSE_ALL_CHECKPOINT_BATCH:
+                await save_checkpoint()
 
-    # Regular expression to parse the expected report format.
-    pattern = (
-        r"Active/Reflective:\s*(.+?)\s+\(score:\s*(\d+)\).*?"
-        r"Sensing/Intuitive:\s*(.+?)\s+\(score:\s*(\d+)\).*?"
-        r"Visual/Verbal:\s*(.+?)\s+\(score:\s*(\d+)\).*?"
-        r"Sequential/Global:\s*(.+?)\s+\(score:\s*(\d+)\)"
-    )
+        if time.monotonic() - last_edit >= ANALYSE_ALL_PROGRESS_INTERVAL:
+            last_edit = time.monotonic()
+            try:
+                await progress_message.edit_text(progress_text())
+            except Exception as edit_error:
+                logging.warning(f"Error updating analysis progress: {edit_error}")
 
-    for uid in user_ids:
-        messages = chat_db.get_all_conversation(user_id=uid)
-        if not messages:
-            await context.bot.send_message(chat_id=admin_id, text=f"User {uid}: No chat history available.")
-            continue
-        try:
-            report = await llm.analyse_all_message(user_id=uid)
+    try:
+        await asyncio.gather(*(analyse_user(uid) for uid in pending))
+    finally:
+        # Whatever finished is kept even if the run is interrupted
+        await save_checkpoint()
 
-            if "No chat history available" in report:
-                await context.bot.send_message(chat_id=admin_id, text=f"User {uid}: Skipped (no chat history).")
-                continue
-            
-            match = re.search(pattern, report, re.DOTALL)
-            if match:
-                # Parse out each dimension's style and score
-                ar_analysis = {"style": match.group(1).strip(), "score": int(match.group(2))}
-                si_analysis = {"style": match.group(3).strip(), "score": int(match.group(4))}
-                vv_analysis = {"style": match.group(5).strip(), "score": int(match.group(6))}
-                sg_analysis = {"style": match.group(7).strip(), "score": int(match.group(8))}
-                
-                # Merge into one dictionary
-                ils_analysis = {
-                    "Active/Reflective": ar_analysis,
-                    "Sensing/Intuitive": si_analysis,
-                    "Visual/Verbal": vv_analysis,
-                    "Sequential/Global": sg_analysis
-                }
-                
-                # Update the user's record with the merged analysis
-                chat_db.users_collection.update_one(
-                    {"user_id": uid},
-                    {"$set": {"chat_ils_analysis": ils_analysis}}
-                )
-                await context.bot.send_message(chat_id=admin_id, text=f"User {uid}: Updated analysis.")
-            else:
-                await context.bot.send_message(chat_id=admin_id, text=f"User {uid}: Failed to parse analysis report.")
-        except Exception as e:
-            await context.bot.send_message(chat_id=admin_id, text=f"User {uid}: Analysis failed with error: {e}")
+    await chat_db.finish_analysis_run(ANALYSE_ALL_RUN_ID, summary=dict(counts, total=len(user_ids)))
+    try:
+        await progress_message.edit_text(progress_text(done=True))
+    except Exception as edit_error:
+        logging.warning(f"Error updating analysis progress: {edit_error}")
+        await bot.send_message(chat_id=admin_id, text=progress_text(done=True))
 
 async def shutdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
     # Check if the user is an admin (replace with your admin check)
-    if not chat_db.is_admin(user_id):
+    if not await chat_db.is_admin(user_id):
         await update.message.reply_text("Unauthorized access.")
         return
     
     await update.message.reply_text("Shutting down...")
     # Stop any background jobs, e.g., the scheduler
     scheduler.shutdown()
+    await flush_write_buffers()
+    docs_process.close()
     # Terminate the script
     sys.exit(0)
 
 
 async def main():
 
+    global chat_db, llm, docs_process, docs_retriever, extraction_cache, broadcast_engine
+    global poll_details_buffer, poll_answer_buffer, scheduler, scheduler_store
+
+    chat_db = chat_database.Async_Chat_DB()
+    llm = llm_module.LLM(Chat_Database=chat_db)
+    docs_process = docs_processor.Docs_processor()
+    docs_retriever = docs_index.Docs_index()
+    extraction_cache = docs_cache.Docs_cache()
+    broadcast_engine = broadcaster.Broadcaster(database=chat_db)
+    poll_details_buffer = write_buffer.Write_buffer(chat_db.store_poll_details_many, max_size=500, interval=1.0, name="poll details")
+    # A quiz brings hundreds of answers within seconds
+    poll_answer_buffer = write_buffer.Write_buffer(write_poll_answers, max_size=POLL_ANSWER_BATCH,
+                                                   interval=POLL_ANSWER_FLUSH_INTERVAL, name="poll answers")
+    # Scheduled jobs are persisted in MongoDB, through the bot's own client, so that a restart
+    # neither loses nor duplicates them
+    scheduler_store = job_store.Async_Job_Store(chat_db.scheduled_jobs_collection)
+    scheduler = AsyncIOScheduler(jobstores={"default": scheduler_store})
+
     # Build the bot application
-    application = ApplicationBuilder().token(TELE_BOT_TOKEN).build()
+    # Updates are processed one at a time, as the poll upload ConversationHandler requires; the slow
+    # handlers (LLM calls, parsing, exports, broadcasts) are registered with block=False so that they
+    # run as background tasks and do not stall every other chat
+    # Buffered database writes are flushed when the application stops
+    application = (
+        ApplicationBuilder()
+        .token(TELE_BOT_TOKEN)
+        .post_shutdown(flush_write_buffers)
+        .build()
+    )
     
     start_handler = CommandHandler('start', start)
     new_convo_handler = CommandHandler('new', new)
-    analyse_handler = CommandHandler("analyse", analyse)
-    misconception_handler = CommandHandler("uncover", misconception)
-    message_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message)
-    document_handler = MessageHandler(filters.ATTACHMENT & (~filters.COMMAND), handle_document)
+    analyse_handler = CommandHandler("analyse", analyse, block=False)
+    misconception_handler = CommandHandler("uncover", misconception, block=False)
+    message_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message, block=False)
+    document_handler = MessageHandler(filters.ATTACHMENT & (~filters.COMMAND), handle_document, block=False)
     query_handler = CallbackQueryHandler(handle_query)
-    export_chat_handler = CommandHandler("export_chat", export_chat)
-    export_feedback_handler = CommandHandler("export_feedback", export_feedback)
-    export_users_handler = CommandHandler("export_users", export_users)
-    announce_handler = CommandHandler("announce", announce)
-    analyse_all_handler = CommandHandler("analyse_all", analyse_all)
-    clear_docs_handler = CommandHandler('clear', clear_documents)
+    export_chat_handler = CommandHandler("export_chat", export_chat, block=False)
+    export_feedback_handler = CommandHandler("export_feedback", export_feedback, block=False)
+    export_users_handler = CommandHandler("export_users", export_users, block=False)
+    announce_handler = CommandHandler("announce", announce, block=False)
+    analyse_all_handler = CommandHandler("analyse_all", analyse_all, block=False)
+    clear_docs_handler = CommandHandler('clear', clear_documents, block=False)
     shutdown_handler = CommandHandler("shutdown", shutdown)
 
     poll_upload_conv_handler = ConversationHandler(
         entry_points=[CommandHandler('upload_poll', start_poll_upload)],
         states={
-            POLL_UPLOAD: [MessageHandler(filters.Document.ALL, process_poll_csv)]
+            # The quiz broadcast runs in the background; the conversation ends when it finishes
+            POLL_UPLOAD: [MessageHandler(filters.Document.ALL, process_poll_csv, block=False)]
         },
         fallbacks=[CommandHandler('cancel', cancel_poll_upload)]
     )
@@ -1120,7 +1497,7 @@ async def main():
     application.add_handler(poll_answer_handler)
     
     # Replace the export quiz command with export poll command
-    export_poll_handler = CommandHandler("export_poll", export_poll_responses)
+    export_poll_handler = CommandHandler("export_poll", export_poll_responses, block=False)
     application.add_handler(export_poll_handler)
     
     application.add_handler(query_handler)
@@ -1142,16 +1519,30 @@ async def main():
     # Set menu commands
     await set_command_menu(application.bot)
 
+    # Load the document embedding model before the first query needs it
+    await asyncio.to_thread(docs_retriever.warm_up)
+
+    # Make sure the collections are indexed before serving traffic
+    await chat_db.ensure_indexes()
+    await chat_db.report_indexes()
+
     # Assign the Application instance to a global variable 'app'
     global app
     app = application
 
-    # Schedule the first daily initiation at a random time between 8 AM and 9 PM
-    first_run = get_next_run_time()
-    scheduler.add_job(daily_initiation_task, 'date', run_date=first_run, id='daily_initiation_task')
+    # Start the scheduler first so that jobs persisted by an earlier run are loaded, then add any
+    # cohort that is missing
+    await scheduler_store.load()
     scheduler.start()
-    logging.info(f"First daily initiation scheduled for {first_run}")
-    await notify_admins(first_run)
+    schedule_daily_initiations()
+    next_runs = get_next_run_times()
+    logging.info(f"Daily initiations scheduled for {next_runs}")
+    await notify_admins(next_runs)
+
+    # Pick up broadcasts that a restart interrupted, without holding up polling; the reference keeps
+    # the task from being garbage-collected before it finishes
+    global resume_task
+    resume_task = asyncio.create_task(resume_broadcasts(application.bot))
 
     # Run the bot
     await application.run_polling()
@@ -1,6 +1,48 @@
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from datetime import datetime
+import json
+
+DIMENSIONS = ["Active/Reflective", "Sensing/Intuitive", "Visual/Verbal", "Sequential/Global"]
+
+
+def _as_text(value):
+    if value == None:
+        return ""
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+
+def _as_score(value):
+    # An integer from 1 to 11, or None
+    try:
+        score = int(value)
+    except (TypeError, ValueError):
+        return None
+    return score if 1 <= score <= 11 else None
+
+
+def normalize_state(response, previous = None):
+    """
+    The learning style state of an LLM response, with every dimension present and typed. Parts that
+    are missing or malformed keep their previous value, so a bad response never corrupts the state.
+    """
+    response = response if isinstance(response, dict) else {}
+    previous = previous or {}
+    new_scores = response.get("scores") if isinstance(response.get("scores"), dict) else {}
+    old_scores = previous.get("scores") if isinstance(previous.get("scores"), dict) else {}
+
+    scores = {}
+    for dimension in DIMENSIONS:
+        entry = new_scores.get(dimension)
+        if not isinstance(entry, dict):
+            entry = old_scores.get(dimension) if isinstance(old_scores.get(dimension), dict) else {}
+        scores[dimension] = {"style": _as_text(entry.get("style")) or "Unknown", "score": _as_score(entry.get("score"))}
+
+    return {
+        "scores": scores,
+        "evidence_summary": _as_text(response.get("evidence_summary")) or _as_text(previous.get("evidence_summary")),
+        "report": _as_text(response.get("report")) or _as_text(previous.get("report")),
+    }
 
 
 class Analyser:
@@ -140,12 +182,69 @@ class Analyser:
         ])
         self.analyse_all_chain = self.analyse_all_prompt | self.llm | StrOutputParser()
 
+        # Incremental analysis: the previous state plus only the messages since it was computed
+        self.incremental_system_prompt = (
+            """
+            You are an AI maintaining a running analysis of a user's learning behavior, based on their chat history with an educational chatbot and the Felder-Silverman Learning Style Model.
+
+            The four dimensions are Active/Reflective, Sensing/Intuitive, Visual/Verbal and Sequential/Global. Each is rated on a scale from 1 to 11:
+            - Scores of 1 or 3: Fairly balanced between the two categories with a mild preference.
+            - Scores of 5 or 7: Moderate preference for one category.
+            - Scores of 9 or 11: Strong preference for one category.
+
+            You are given the previous analysis state (scores and an evidence summary built from earlier messages, or null if there is none) and only the messages sent since then.
+            Update the state using the new messages: keep the earlier evidence, add what the new messages show, and only move a score when the new evidence supports it.
+
+            Respond with a single JSON object and nothing else, in this format:
+            {{
+                "scores": {{
+                    "Active/Reflective": {{"style": "<Active or Reflective, or Unknown>", "score": <integer 1-11 or null>}},
+                    "Sensing/Intuitive": {{"style": "<Sensing or Intuitive, or Unknown>", "score": <integer 1-11 or null>}},
+                    "Visual/Verbal": {{"style": "<Visual or Verbal, or Unknown>", "score": <integer 1-11 or null>}},
+                    "Sequential/Global": {{"style": "<Sequential or Global, or Unknown>", "score": <integer 1-11 or null>}}
+                }},
+                "evidence_summary": "<concise summary of the evidence for every dimension so far, at most 300 words>",
+                "report": "<learning analysis report for the user>"
+            }}
+
+            The report starts with *Here is a learning behavior analysis report as of {datetime} using the Felder-Silverman Learning Style Model:* and then, for each dimension, states the preference and rating with examples from the evidence, followed by learning behavior insights and tailored learning strategies.
+            If there is not enough information to classify a dimension, say so in the report for that dimension.
+            The report is formatted in Markdown (`*bold*`, `_italic_`) and kept within 4096 characters.
+            """
+        )
+        self.incremental_prompt = ChatPromptTemplate.from_messages([
+            ("system", self.incremental_system_prompt),
+            ("human", "Previous state: {state}\n\nNew chat messages: {chat_history}\n\nReturn the updated analysis state.")
+        ])
+        self.incremental_chain = self.incremental_prompt | self.llm | JsonOutputParser()
+
+    def no_history_report(self):
+        return (f"*There is no chat history available as of {datetime.now().replace(microsecond=0)}. "
+                "Therefore, no learning behavior analysis can be provided at this time.*")
+
+    async def update_analysis(self, state, messages):
+        """
+        Folds new messages into a learning style state of the form
+        {"scores": ..., "evidence_summary": ..., "report": ...}; state is None on the first run.
+        """
+        previous = None
+        if state:
+            previous = {"scores": state.get("scores"), "evidence_summary": state.get("evidence_summary")}
+
+        response = await self.incremental_chain.ainvoke({
+            "datetime": datetime.now().replace(microsecond=0),
+            "state": previous,
+            "chat_history": messages
+        })
+
+        return normalize_state(response, previous=state)
+
     async def get_analysis(self, messages):
 
-        response = self.analyse_chain.invoke({"datetime": datetime.now().replace(microsecond=0), "chat_history": messages})
+        response = await self.analyse_chain.ainvoke({"datetime": datetime.now().replace(microsecond=0), "chat_history": messages})
     
         return response
     
     async def get_analysis_all(self, messages):
-        response = self.analyse_all_chain.invoke({"chat_history": messages})
+        response = await self.analyse_all_chain.ainvoke({"chat_history": messages})
         return response
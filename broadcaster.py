@@ -0,0 +1,194 @@
+# importing os module for environment variables
+import os
+# importing necessary functions from dotenv library
+from dotenv import load_dotenv
+
+import asyncio
+import logging
+import time
+import weakref
+from datetime import timedelta
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+
+load_dotenv() # Load environment variables from .env file
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 20)) # Sends in flight at once
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25)) # Messages per second across all chats
+BROADCAST_CHAT_INTERVAL = float(os.environ.get('BROADCAST_CHAT_INTERVAL', 1.0)) # Seconds between messages to one chat
+BROADCAST_RETRIES = int(os.environ.get('BROADCAST_RETRIES', 3))
+
+class Rate_limiter:
+    """
+    Spaces out calls to acquire() by `interval` seconds per key.
+    The key None is the global limit; any other key (a chat id) gets its own schedule.
+    """
+    def __init__(self, interval: float, max_keys: int = 10000):
+        self.interval = interval
+        self.max_keys = max_keys
+        self.next_slot = {}
+
+    async def acquire(self, key=None):
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot.get(key, 0.0))
+        self.next_slot[key] = slot + self.interval
+
+        if len(self.next_slot) > self.max_keys:
+            # Forget keys whose schedule is already in the past
+            self.next_slot = {k: t for k, t in self.next_slot.items() if t > now or k is None}
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float, key=None):
+        # Push the next free slot back, e.g. after Telegram's flood control asked us to wait
+        resume = asyncio.get_running_loop().time() + seconds
+        self.next_slot[key] = max(self.next_slot.get(key, 0.0), resume)
+
+
+def _seconds(retry_after):
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class Broadcaster:
+    """
+    Sends one payload to many chats with bounded concurrency, within Telegram's global and per-chat
+    rate limits, retrying on RetryAfter and transient network errors.
+
+    When a database and job_id are given, each chat id is saved as delivered as soon as its send
+    completes, so an interrupted broadcast can be resumed. Only chats whose send was in flight when
+    the process stopped may be messaged again.
+    """
+    def __init__(self, database = None, max_concurrency: int = None, rate: float = None,
+                 chat_interval: float = None, max_retries: int = None):
+
+        self.database = database
+        self.max_retries = max_retries if max_retries != None else BROADCAST_RETRIES
+
+        self.semaphore = asyncio.Semaphore(max_concurrency if max_concurrency != None else BROADCAST_CONCURRENCY)
+        self.global_limiter = Rate_limiter(interval=1 / (rate if rate != None else BROADCAST_RATE))
+        self.chat_limiter = Rate_limiter(interval=chat_interval if chat_interval != None else BROADCAST_CHAT_INTERVAL)
+
+        # Per-job locks; entries go away once no run holds them
+        self.job_locks = weakref.WeakValueDictionary()
+
+    async def throttle(self, chat_id):
+        # Waits for a free slot under both limits; send functions that post several messages call it between them
+        await self.chat_limiter.acquire(chat_id)
+        await self.global_limiter.acquire()
+
+    async def _send_with_retry(self, chat_id, send):
+        # Returns "sent", "blocked" (the user blocked the bot or left) or "failed"
+        for attempt in range(self.max_retries + 1):
+            await self.throttle(chat_id)
+            try:
+                await send(chat_id)
+                return "sent"
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so every sender waits
+                delay = _seconds(e.retry_after)
+                logging.warning(f"Flood control while sending to {chat_id}, retrying in {delay}s")
+                self.global_limiter.pause(delay)
+            except Forbidden as e:
+                logging.info(f"Chat {chat_id} is unreachable: {e}")
+                return "blocked"
+            except BadRequest as e:
+                logging.error(f"Bad request while sending to {chat_id}: {e}")
+                return "failed"
+            except NetworkError as e:
+                logging.warning(f"Network error while sending to {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logging.error(f"Error sending to {chat_id}: {e}")
+                return "failed"
+        return "failed"
+
+    async def broadcast(self, recipients, send, job_id: str = None, description: str = "Broadcast", payload: dict = None,
+                        prepare = None, prepare_concurrency: int = None):
+        """
+        Calls the coroutine function send(chat_id) once for every recipient.
+        payload is stored with the job so that resume_broadcasts can rebuild `send` after a restart.
+
+        When prepare is given, each chat goes through two pipelined stages: prepare(chat_id) runs with at
+        most prepare_concurrency calls in flight (e.g. LLM generation), then send(chat_id, prepared) is
+        delivered under the usual rate limits. Chats are delivered as soon as their content is ready.
+
+        Runs with the same job_id are serialized; a later run only sends to chats the earlier one did not handle.
+
+        Returns a summary dict with the sent/blocked/failed/skipped counts, the elapsed time and
+        per-stage timing stats.
+        """
+        # Runs of the same job (e.g. a resumed one and its scheduled run) must not overlap, or both would
+        # message the chats that neither has marked as delivered yet
+        lock = self.job_locks.setdefault(job_id, asyncio.Lock()) if job_id else asyncio.Lock()
+        async with lock:
+            started = time.monotonic()
+            recipients = list(dict.fromkeys(recipients)) # Drop duplicates, keep order
+
+            done = set()
+            if job_id and self.database:
+                done = await self.database.start_broadcast(job_id=job_id, description=description,
+                                                           recipients=recipients, payload=payload)
+            pending = [chat_id for chat_id in recipients if chat_id not in done]
+
+            summary = {"description": description, "total": len(recipients), "sent": 0, "blocked": 0,
+                       "failed": 0, "skipped": len(recipients) - len(pending)}
+            timings = {"prepare": [], "send": []}
+            prepare_semaphore = asyncio.Semaphore(prepare_concurrency or len(pending) or 1)
+
+            async def deliver(chat_id):
+                deliver_send = send
+                if prepare != None:
+                    async with prepare_semaphore:
+                        prepare_started = time.monotonic()
+                        try:
+                            prepared = await prepare(chat_id)
+                        except Exception as e:
+                            logging.error(f"Error preparing message for {chat_id}: {e}")
+                            summary["failed"] += 1
+                            return
+                        timings["prepare"].append(time.monotonic() - prepare_started)
+                    deliver_send = lambda chat_id: send(chat_id, prepared)
+
+                async with self.semaphore:
+                    send_started = time.monotonic()
+                    status = await self._send_with_retry(chat_id, deliver_send)
+                    timings["send"].append(time.monotonic() - send_started)
+                summary[status] += 1
+                # Saved per chat so that a restart only repeats the sends in flight; failed chats stay
+                # pending so a resumed job retries them
+                if status != "failed" and job_id and self.database:
+                    await self.database.mark_broadcast_delivered(job_id=job_id, chat_ids=[chat_id])
+
+            await asyncio.gather(*(deliver(chat_id) for chat_id in pending))
+
+            summary["elapsed"] = round(time.monotonic() - started, 1)
+            for stage, durations in timings.items():
+                if durations:
+                    summary[f"{stage}_avg"] = round(sum(durations) / len(durations), 2)
+                    summary[f"{stage}_max"] = round(max(durations), 2)
+            if job_id and self.database:
+                await self.database.finish_broadcast(job_id=job_id, summary=summary)
+
+            logging.info(f"Broadcast finished: {summary}")
+            return summary
+
+    @staticmethod
+    def format_summary(summary: dict):
+        text = (f"{summary['description']}: delivered to {summary['sent']} of {summary['total']} chat(s) "
+                f"in {summary['elapsed']}s.")
+        if summary["blocked"]:
+            text += f"\n{summary['blocked']} chat(s) unreachable."
+        if summary["failed"]:
+            text += f"\n{summary['failed']} chat(s) failed."
+        if "prepare_avg" in summary:
+            text += f"\nPreparation: {summary['prepare_avg']}s average, {summary['prepare_max']}s slowest."
+        if "send_avg" in summary:
+            text += f"\nDelivery: {summary['send_avg']}s average, {summary['send_max']}s slowest."
+        if summary["skipped"]:
+            text += f"\n{summary['skipped']} chat(s) already handled before a restart."
+        return text
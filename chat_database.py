@@ -4,32 +4,251 @@ import os
 from dotenv import load_dotenv, dotenv_values 
 
 # importing MongoDB modules
-from pymongo import MongoClient
-from datetime import datetime
-from langchain_mongodb.chat_message_histories import MongoDBChatMessageHistory
+from pymongo import AsyncMongoClient, IndexModel, ReturnDocument, UpdateOne, DeleteOne, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, BulkWriteError
+from datetime import datetime, timedelta, timezone
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage, BaseMessage, message_to_dict, messages_from_dict
+from cachetools import LRUCache, TTLCache
+from typing import Sequence
 import csv
+import gzip
+import io
+import json
+import logging
+import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
 from bson.objectid import ObjectId
 
 load_dotenv() # Load environment variables from .env file
 
-class Chat_DB:
+# Maximum number of chat history handles kept per Async_Chat_DB instance
+HISTORY_CACHE_SIZE = int(os.environ.get('HISTORY_CACHE_SIZE', 1024))
+# Size and time-to-live (seconds) of the in-process users document cache
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 4096))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
+# poll_id -> poll_details documents of polls sent but not yet answered
+POLL_DETAILS_CACHE_SIZE = int(os.environ.get('POLL_DETAILS_CACHE_SIZE', 50000))
+# Days an index must have been observed (since creation or the last mongod restart) before it is reported unused
+INDEX_UNUSED_DAYS = int(os.environ.get('INDEX_UNUSED_DAYS', 7))
+# Documents sampled to infer an export's columns, and bytes of compressed export kept in memory before spilling to disk
+EXPORT_SCHEMA_SAMPLE = int(os.environ.get('EXPORT_SCHEMA_SAMPLE', 1000))
+EXPORT_SPOOL_SIZE = int(os.environ.get('EXPORT_SPOOL_SIZE', 16 * 1024 * 1024))
+
+EXPORT_EXTRA_COLUMN = "_extra" # Fields missing from the inferred columns, as JSON
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 10000)) # Rows per Parquet record batch
+EXPORT_MAX_BYTES = int(os.environ.get('EXPORT_MAX_BYTES', 50 * 1024 * 1024)) # Largest export file; Telegram bots cannot upload more
+EXPORT_SIZE_CHECK_ROWS = 1000 # Rows written between checks of the export size
+
+# Typed columns of the Parquet exports
+CHAT_EXPORT_SCHEMA = pa.schema([
+    ("message_id", pa.string()),
+    ("user_id", pa.int64()),
+    ("conversation_id", pa.int64()),
+    ("timestamp", pa.timestamp("ms", tz="UTC")),
+    ("message_type", pa.string()),
+    ("content", pa.string()),
+])
+POLL_EXPORT_SCHEMA = pa.schema([
+    ("response_id", pa.string()),
+    ("poll_number", pa.int64()),
+    ("poll_id", pa.string()),
+    ("user_id", pa.int64()),
+    ("question", pa.string()),
+    ("student_answer", pa.string()),
+    ("timestamp", pa.timestamp("ms")),
+])
+
+
+class Empty_export(LookupError):
+    """Raised by the export methods when no document matches; with filters this is a normal outcome."""
+
+
+class Export_too_large(Exception):
+    """Raised by the export methods as soon as the file grows past EXPORT_MAX_BYTES."""
+    def __init__(self, max_bytes: int):
+        super().__init__(f"The export is larger than {max_bytes // (1024 * 1024)} MB, the most a Telegram bot can send. "
+                         "Narrow it with from=/to=, users= or fields=.")
+
+
+def _check_export_size(spool):
+    if spool.tell() > EXPORT_MAX_BYTES:
+        raise Export_too_large(EXPORT_MAX_BYTES)
+
+def index_plan(chat_db):
+    """
+    Returns the indexes backing Async_Chat_DB's queries as a list of (collection, [IndexModel]) pairs.
+    """
+    return [
+        (chat_db.users_collection, [
+            # is_user_authenticated / user_exist / is_admin lookups
+            IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        ]),
+        (chat_db.chat_collection, [
+            # History of one session, a user's full history and the most recent conversation id
+            IndexModel([("SessionId.user_id", ASCENDING), ("SessionId.conversation_id", ASCENDING), ("_id", ASCENDING)],
+                       name="session_user_conversation"),
+            # A user's messages in insertion order, read incrementally by get_messages_since
+            IndexModel([("SessionId.user_id", ASCENDING), ("_id", ASCENDING)], name="user_message_order"),
+        ]),
+        (chat_db.poll_details_collection, [
+            IndexModel([("poll_id", ASCENDING)], name="poll_id_unique", unique=True),
+            # get_latest_poll_number
+            IndexModel([("poll_number", DESCENDING)], name="poll_number_desc"),
+        ]),
+        (chat_db.poll_responses_collection, [
+            # Idempotent upserts of buffered poll answers
+            IndexModel([("poll_id", ASCENDING)], name="poll_id"),
+            # Filtered /export_poll: by poll, by user and by date
+            IndexModel([("poll_number", ASCENDING), ("user_id", ASCENDING)], name="poll_number_user"),
+            IndexModel([("user_id", ASCENDING), ("timestamp", ASCENDING)], name="user_timestamp"),
+            IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+        ]),
+        (chat_db.feedback_collection, [
+            # Filtered /export_feedback; dates are taken from _id
+            IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_id_order"),
+            IndexModel([("sentiment", ASCENDING), ("_id", ASCENDING)], name="sentiment_order"),
+        ]),
+        (chat_db.db["ils_answers"], [
+            IndexModel([("user_id", ASCENDING), ("question_index", ASCENDING)], name="user_question_unique", unique=True),
+        ]),
+        (chat_db.db["misconceptions"], [
+            # One finding per user and topic, merged across incremental /uncover runs
+            IndexModel([("user_id", ASCENDING), ("topic_key", ASCENDING)], name="user_topic_unique", unique=True),
+        ]),
+        (chat_db.db["broadcasts"], [
+            # Unfinished broadcasts resumed at startup
+            IndexModel([("status", ASCENDING)], name="status"),
+        ]),
+    ]
+
+
+def _csv_value(value):
+    # Flatten a BSON value into a CSV cell
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, ensure_ascii=False)
+    return str(value)
+
+
+def _chat_export_row(document: dict):
+    message = json.loads(document["History"])
+    content = message.get("data", {}).get("content", "")
+    return {
+        "message_id": str(document["_id"]),
+        "user_id": document["SessionId"]["user_id"],
+        "conversation_id": document["SessionId"].get("conversation_id"),
+        "timestamp": document["_id"].generation_time,
+        "message_type": message.get("type"),
+        "content": content if isinstance(content, str) else json.dumps(content, ensure_ascii=False),
+    }
+
+
+def _poll_export_row(document: dict):
+    return {
+        "response_id": str(document["_id"]),
+        "poll_number": document.get("poll_number"),
+        "poll_id": document.get("poll_id"),
+        "user_id": document.get("user_id"),
+        "question": document.get("question"),
+        "student_answer": document.get("student_answer"),
+        "timestamp": document.get("timestamp"),
+    }
+
+
+def _index_report(collection, declared: list, existing: dict, stats: list):
+    # Compare declared indexes against the server's, and flag indexes with no recorded use.
+    # Usage counters restart with the index or with mongod, so only indexes observed for at least
+    # INDEX_UNUSED_DAYS are flagged
+    missing = [(collection.name, model.document["name"]) for model in declared if model.document["name"] not in existing]
+    observed_before = datetime.now(timezone.utc) - timedelta(days=INDEX_UNUSED_DAYS)
+    unused = []
+    for stat in stats:
+        since = stat["accesses"]["since"]
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc) # pymongo returns naive UTC datetimes by default
+        if stat["name"] != "_id_" and stat["accesses"]["ops"] == 0 and since <= observed_before:
+            unused.append((collection.name, stat["name"]))
+    return missing, unused
+
+
+class Async_Only_History(BaseChatMessageHistory):
+    """
+    Base of chat histories backed by an AsyncMongoClient. Its collections cannot be read or written
+    from synchronous code, so only aget_messages/aadd_messages/aclear are available: run chains that
+    use these histories with ainvoke/astream, never invoke/stream.
+    """
+    def _async_only(self, method: str):
+        return TypeError(f"{type(self).__name__} is async-only; use {method}() (e.g. through ainvoke or astream).")
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        raise self._async_only("aget_messages")
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        raise self._async_only("aadd_messages")
+
+    def clear(self) -> None:
+        raise self._async_only("aclear")
+
+    def __str__(self):
+        # BaseChatMessageHistory renders self.messages, which needs a round trip
+        return f"<{type(self).__name__}>"
+
+
+class Async_Chat_History(Async_Only_History):
+    """
+    Chat message history for one (user_id, conversation_id) session that reuses an existing
+    AsyncMongoClient collection.
+
+    Documents keep the layout written by langchain_mongodb's MongoDBChatMessageHistory
+    ({"SessionId": ..., "History": <json message>}), so existing history stays readable, but no
+    MongoClient (and connection pool) is opened per session.
+    """
+    def __init__(self, collection, session_id: dict):
+        self.collection = collection
+        self.session_id = session_id
+
+    def _query(self):
+        # Match on the individual fields so the lookup can use the SessionId.* index
+        return {f"SessionId.{key}": value for key, value in self.session_id.items()}
+
+    def _document(self, message: BaseMessage):
+        return {"SessionId": self.session_id, "History": json.dumps(message_to_dict(message))}
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        cursor = self.collection.find(self._query(), {"History": 1}).sort("_id", 1)
+        return messages_from_dict([json.loads(document["History"]) async for document in cursor])
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if messages:
+            await self.collection.insert_many([self._document(message) for message in messages])
+
+    async def aclear(self) -> None:
+        await self.collection.delete_many(self._query())
+
+
+class Async_Chat_DB:
+    """
+    The bot's MongoDB access layer, built on pymongo's AsyncMongoClient. Every database round trip
+    is a coroutine so that handlers can await it without blocking the event loop.
+    """
     def __init__(self, MONGO_URI: str = None, database_name: str = None, users_collection_name: str = None, chat_collection_name: str = None):
 
-        if MONGO_URI == None:
-            self.MONGO_URI = os.environ.get('MONGO_URI')
-        if database_name == None:
-            self.database_name = 'telegram_bot_db'
-        if users_collection_name == None:
-            self.users_collection_name = 'users'
-        if chat_collection_name == None:
-            self.chat_collection_name = 'chat_history'
-   
+        self.MONGO_URI = MONGO_URI if MONGO_URI != None else os.environ.get('MONGO_URI')
+        self.database_name = database_name if database_name != None else 'telegram_bot_db'
+        self.users_collection_name = users_collection_name if users_collection_name != None else 'users'
+        self.chat_collection_name = chat_collection_name if chat_collection_name != None else 'chat_history'
+
         self.callback_collection_name = 'callback_collection'
         self.feedback_collection_name = "feedback_collection"
-        
 
         # MongoDB connection setup
-        self.client = MongoClient(self.MONGO_URI)
+        self.client = AsyncMongoClient(self.MONGO_URI)
         self.db = self.client[self.database_name] # The name of the database
         self.users_collection = self.db[self.users_collection_name] # Collection to store user details
         self.chat_collection = self.db[self.chat_collection_name] # Collection to store chat history
@@ -40,158 +259,280 @@ class Chat_DB:
         self.poll_details_collection = self.db[self.poll_details_collection_name]
         self.poll_responses_collection_name = "poll_responses"
         self.poll_responses_collection = self.db[self.poll_responses_collection_name]
-
-
+        self.broadcasts_collection = self.db["broadcasts"] # Progress of announcement/poll broadcasts
+        self.analysis_runs_collection = self.db["analysis_runs"] # Checkpoints of /analyse_all batch runs
+        self.learning_style_collection = self.db["learning_style_state"] # Rolling learning style analysis per user
+        self.misconceptions_collection = self.db["misconceptions"] # Misconceptions found per user and topic
+        self.misconception_state_collection = self.db["misconception_state"] # Last message analysed for misconceptions
+        self.history_summaries_collection = self.db["history_summaries"] # Summaries of turns older than the history window
+        self.scheduled_jobs_collection = self.db["scheduled_jobs"] # Jobs of the bot's scheduler
+
+        # Bounded cache of history handles, all sharing self.client's connection pool
+        self.history_cache = LRUCache(maxsize=HISTORY_CACHE_SIZE)
+
+        # users documents keyed by user_id; every write to a users document must invalidate its entry
+        self.user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+        # Current conversation id per user, mirrored in the users document as current_conversation_id
+        self.conversation_cache = LRUCache(maxsize=USER_CACHE_SIZE)
+
+        # Details of polls awaiting an answer, filled when the poll is sent
+        self.poll_details_cache = LRUCache(maxsize=POLL_DETAILS_CACHE_SIZE)
+
+    async def ensure_indexes(self):
+        # Idempotently create every declared index; safe to call on each startup
+        for collection, models in index_plan(self):
+            try:
+                await collection.create_indexes(models)
+            except OperationFailure as e:
+                logging.error(f"Failed to create indexes on {collection.name}: {e}")
+
+    async def report_indexes(self):
+        # Log declared indexes that are missing and existing indexes that have never been used
+        report = {"missing": [], "unused": []}
+        for collection, models in index_plan(self):
+            try:
+                existing = await collection.index_information()
+                stats = await (await collection.aggregate([{"$indexStats": {}}])).to_list()
+            except OperationFailure as e:
+                logging.error(f"Failed to read indexes of {collection.name}: {e}")
+                continue
+            missing, unused = _index_report(collection, models, existing, stats)
+            report["missing"].extend(missing)
+            report["unused"].extend(unused)
+
+        for collection_name, index_name in report["missing"]:
+            logging.warning(f"Missing index {index_name} on {collection_name}")
+        for collection_name, index_name in report["unused"]:
+            logging.warning(f"Unused index {index_name} on {collection_name}")
+
+        return report
+
+    # Cached lookup of a users document; unknown users are cached as an empty dict
+    async def get_user(self, user_id: int):
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = await self.users_collection.find_one({"user_id": user_id}) or {}
+            self.user_cache[user_id] = user
+        return user
+
+    def invalidate_user(self, user_id: int):
+        self.user_cache.pop(user_id, None)
 
     # Helper function to check if a user is authenticated
-    def is_user_authenticated(self, user_id: int):
-        user = self.users_collection.find_one({"user_id": user_id})
-        if user:
-            if user.get("is_authenticated"):
-                return True
-            else:
-                return False
-        else:
-            
-            return False
-    
-    def user_exist(self, user_id: int):
-        user = self.users_collection.find_one({"user_id": user_id})
+    async def is_user_authenticated(self, user_id: int):
+        user = await self.get_user(user_id)
+        return bool(user and user.get("is_authenticated"))
+
+    async def user_exist(self, user_id: int):
+        user = await self.get_user(user_id)
         return True if user else False
-    
-    def is_admin(self, user_id: int):
-        user = self.users_collection.find_one({"user_id": user_id})
+
+    async def is_admin(self, user_id: int):
+        user = await self.get_user(user_id)
         return user.get("is_admin")
 
-    def get_by_session_id(self, user_id: int, conversation_id: int) -> MongoDBChatMessageHistory:
+    async def set_admin(self, user_id: int, is_admin: bool = True):
+        await self.users_collection.update_one({"user_id": user_id}, {"$set": {"is_admin": is_admin}})
+        self.invalidate_user(user_id)
 
-        return MongoDBChatMessageHistory(
-                session_id={"user_id": int(user_id), "conversation_id": int(conversation_id)},
-                connection_string=self.MONGO_URI,
-                database_name=self.database_name,
-                collection_name=self.chat_collection_name,
-            )
-    
-    def get_recent_conversation(self, user_id: int):
+    # Synchronous on purpose: RunnableWithMessageHistory calls the factory synchronously and
+    # then awaits the history's async methods.
+    def get_by_session_id(self, user_id: int, conversation_id: int) -> Async_Chat_History:
+
+        key = (int(user_id), int(conversation_id))
+        history = self.history_cache.get(key)
+        if history is None:
+            history = Async_Chat_History(
+                    collection=self.chat_collection,
+                    session_id={"user_id": key[0], "conversation_id": key[1]},
+                )
+            self.history_cache[key] = history
+
+        return history
+
+    async def _find_recent_conversation(self, user_id: int):
 
         # Query the chat collection for the most recent conversation of the given user
-        recent_conversation = self.chat_collection.find({ "SessionId.user_id": int(user_id)}).sort("SessionId.conversation_id", -1).limit(1).to_list()
-  
+        recent_conversation = await self.chat_collection.find({ "SessionId.user_id": int(user_id)}, {"SessionId": 1}).sort("SessionId.conversation_id", -1).limit(1).to_list()
+
         # If a conversation is found, return the conversation_id
         if len(recent_conversation) > 0:
-
-            
             return recent_conversation[0].get("SessionId").get("conversation_id")
-        
+
         # If no conversation is found, return 1
         return 1
-    
-    def get_callback_data(self, object_id: str):
 
-        object_id = ObjectId(object_id)
+    async def get_recent_conversation(self, user_id: int):
+
+        user_id = int(user_id)
+        conversation_id = self.conversation_cache.get(user_id)
+
+        if conversation_id is None:
+            conversation_id = (await self.get_user(user_id)).get("current_conversation_id")
+
+        if conversation_id is None:
+            # Users created before current_conversation_id existed: derive it once from the chat history.
+            # $max keeps a concurrent start_new_conversation from being rolled back.
+            conversation_id = await self._find_recent_conversation(user_id)
+            await self.users_collection.update_one({"user_id": user_id}, {"$max": {"current_conversation_id": conversation_id}})
+            self.invalidate_user(user_id)
+
+        self.conversation_cache[user_id] = conversation_id
+        return conversation_id
+
+    async def get_callback_data(self, object_id: str):
 
         # Query the document by _id
-        document = self.callback_collection.find_one({"_id": object_id})
+        document = await self.callback_collection.find_one({"_id": ObjectId(object_id)})
         prompt = document.get("prompt")
         response = document.get("response")
         conversation_id = document.get("conversation_id")
-        
- 
+
         return [prompt, response, conversation_id]
-        
-    def get_all_conversation(self, user_id: int):
+
+    async def iter_all_conversation(self, user_id: int):
+
+        # Stream every message of the user in one sorted query, ordered by conversation then insertion
+        cursor = self.chat_collection.find(
+            {"SessionId.user_id": int(user_id)}, {"History": 1}
+        ).sort([("SessionId.conversation_id", 1), ("_id", 1)])
+
+        async for document in cursor:
+            yield messages_from_dict([json.loads(document["History"])])[0]
+
+    async def get_all_conversation(self, user_id: int):
+
+        return [message async for message in self.iter_all_conversation(user_id=user_id)]
+
+    def _message_query(self, user_id: int, conversation_id: int = None):
+        query = {"SessionId.user_id": int(user_id)}
+        if conversation_id != None:
+            query["SessionId.conversation_id"] = int(conversation_id)
+        return query
+
+    async def get_messages_since(self, user_id: int, after_id: ObjectId = None, limit: int = 0,
+                                 conversation_id: int = None, before_id: ObjectId = None):
+        # The user's messages stored after after_id (and before before_id), oldest first, as (message_id, message) pairs
+        query = self._message_query(user_id, conversation_id)
+        if after_id != None or before_id != None:
+            query["_id"] = {}
+            if after_id != None:
+                query["_id"]["$gt"] = after_id
+            if before_id != None:
+                query["_id"]["$lt"] = before_id
+
+        cursor = self.chat_collection.find(query, {"History": 1}).sort("_id", 1).limit(limit)
+
+        return [(document["_id"], messages_from_dict([json.loads(document["History"])])[0]) async for document in cursor]
+
+    async def get_recent_messages(self, user_id: int, max_tokens: int, token_counter, conversation_id: int = None,
+                                  page_size: int = 20):
+        """
+        Reads the user's messages newest first, a page at a time, until token_counter says the next one
+        would not fit in max_tokens. The most recent message is always included.
+        Returns (messages oldest first, _id of the oldest message returned, whether older messages exist).
+        """
+        cursor = self.chat_collection.find(
+            self._message_query(user_id, conversation_id), {"History": 1}
+        ).sort("_id", -1).batch_size(page_size)
 
         messages = []
-        recent_convo_id = self.get_recent_conversation(user_id=int(user_id))
+        oldest_id = None
+        has_older = False
+        used = 0
+        try:
+            async for document in cursor:
+                message = messages_from_dict([json.loads(document["History"])])[0]
+                tokens = token_counter([message])
+                if messages and used + tokens > max_tokens:
+                    has_older = True
+                    break
+                messages.append(message)
+                oldest_id = document["_id"]
+                used += tokens
+        finally:
+            await cursor.close()
+
+        messages.reverse()
+        return messages, oldest_id, has_older
+
+    async def get_history_summary(self, user_id: int, conversation_id: int = None):
+        # Rolling summary of messages that no longer fit in the history window; None if there is none yet
+        return await self.history_summaries_collection.find_one({"_id": f"{int(user_id)}:{conversation_id if conversation_id != None else 'all'}"})
+
+    async def store_history_summary(self, user_id: int, conversation_id: int, summary: str, until_id: ObjectId):
+        await self.history_summaries_collection.update_one(
+            {"_id": f"{int(user_id)}:{conversation_id if conversation_id != None else 'all'}"},
+            {"$set": {"summary": summary, "until_id": until_id, "updated": datetime.now()}},
+            upsert=True
+        )
 
-        if recent_convo_id:
+    async def add_human_message(self, message: str, user_id: int):
 
-            for convo_id in range(1, recent_convo_id + 1):
-                messages.extend(self.get_by_session_id(user_id=int(user_id), conversation_id=convo_id).messages)
-                
-        return messages
-    
-    def add_human_message(self, message: str, user_id: int):
+        conversation_id = await self.get_recent_conversation(user_id)
 
-        conversation_id = self.get_recent_conversation(user_id)
+        await self.get_by_session_id(user_id=user_id, conversation_id=conversation_id).aadd_messages([HumanMessage(content=message)])
 
-        chat_session_history = MongoDBChatMessageHistory(
-                session_id={"user_id": user_id, "conversation_id": conversation_id},
-                connection_string=self.MONGO_URI,
-                database_name=self.database_name,
-                collection_name=self.chat_collection_name,
-                )
-        
-        chat_session_history.add_user_message(message=message)
-        
         return
-    
-    def add_ai_message(self, message: str, user_id: int):
 
-        conversation_id = self.get_recent_conversation(user_id)
+    async def add_ai_message(self, message: str, user_id: int):
+
+        conversation_id = await self.get_recent_conversation(user_id)
+
+        await self.get_by_session_id(user_id=user_id, conversation_id=conversation_id).aadd_messages([AIMessage(content=message)])
 
-        chat_session_history = MongoDBChatMessageHistory(
-                session_id={"user_id": user_id, "conversation_id": conversation_id},
-                connection_string=self.MONGO_URI,
-                database_name=self.database_name,
-                collection_name=self.chat_collection_name,
-                )
-        
-        chat_session_history.add_ai_message(message=message)
-        
         return
 
+    async def start_new_conversation(self, message: str, user_id: int):
 
-    
-    def start_new_conversation(self, message: str, user_id: int):
+        user_id = int(user_id)
+        previous_id = await self.get_recent_conversation(user_id)
 
-        conversation_id = self.get_recent_conversation(user_id) + 1
+        # Atomically bump the counter stored on the users document
+        user = await self.users_collection.find_one_and_update(
+            {"user_id": user_id},
+            [{"$set": {"current_conversation_id": {"$add": [{"$ifNull": ["$current_conversation_id", previous_id]}, 1]}}}],
+            projection={"current_conversation_id": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        # Users without a users document (e.g. mid-questionnaire) only keep the counter in memory
+        conversation_id = user["current_conversation_id"] if user else previous_id + 1
 
-        chat_session_history = MongoDBChatMessageHistory(
-                session_id={"user_id": int(user_id), "conversation_id": conversation_id},
-                connection_string=self.MONGO_URI,
-                database_name=self.database_name,
-                collection_name=self.chat_collection_name,
-                )
+        self.conversation_cache[user_id] = conversation_id
+        self.invalidate_user(user_id)
 
-        chat_session_history.add_ai_message(message=message)
+        await self.get_by_session_id(user_id=user_id, conversation_id=conversation_id).aadd_messages([AIMessage(content=message)])
 
         return conversation_id
 
-    def get_all_students(self):
+    async def get_all_students(self):
         # Query for documents where 'is_admin' is False and only return the 'user_id' field
         cursor = self.users_collection.find({"is_admin": False}, {"user_id": 1, "_id": 0})
-        # Build a list of user_ids from the query results
-        user_ids = [doc["user_id"] for doc in cursor if "user_id" in doc]
-        return user_ids
-    
-    def get_all_admins(self):
+        return [doc["user_id"] async for doc in cursor if "user_id" in doc]
+
+    async def get_all_admins(self):
         # Query for documents where 'is_admin' is True and only return the 'user_id' field
         cursor = self.users_collection.find({"is_admin": True}, {"user_id": 1, "_id": 0})
-        # Build a list of user_ids from the query results
-        user_ids = [doc["user_id"] for doc in cursor if "user_id" in doc]
-        return user_ids
-    
-    def get_all_users(self):
-        cursor = self.users_collection.find({}, {"user_id": 1, "_id": 0})
-        user_ids = [doc["user_id"] for doc in cursor if "user_id" in doc]
-        return user_ids
+        return [doc["user_id"] async for doc in cursor if "user_id" in doc]
 
+    async def get_all_users(self):
+        cursor = self.users_collection.find({}, {"user_id": 1, "_id": 0})
+        return [doc["user_id"] async for doc in cursor if "user_id" in doc]
 
-    
-    def input_callback_data(self, prompt: str, response: str, conversation_id: int):
+    async def input_callback_data(self, prompt: str, response: str, conversation_id: int):
 
-        document = self.callback_collection.insert_one({
+        document = await self.callback_collection.insert_one({
                 "prompt" : prompt,
                 "response" : response,
                 "conversation_id" : conversation_id,
         })
 
         return str(document.inserted_id)
-    
-    def input_feedback_data(self, prompt: str, response: str, conversation_id: int, user_id: int, sentiment : str):
 
-        document = self.feedback_collection.insert_one({
+    async def input_feedback_data(self, prompt: str, response: str, conversation_id: int, user_id: int, sentiment : str):
+
+        document = await self.feedback_collection.insert_one({
                 "prompt" : prompt,
                 "response" : response,
                 "conversation_id" : conversation_id,
@@ -200,33 +541,53 @@ class Chat_DB:
         })
 
         return str(document.inserted_id)
-    
-    def store_poll_details(self, poll_number: int, poll_id: str, question: str, options: list):
-        document = {
+
+    def poll_details_document(self, poll_number: int, poll_id: str, question: str, options: list):
+        return {
             "poll_number": poll_number,
             "poll_id": poll_id,
             "question": question,
             "options": options,
             "timestamp": datetime.now()
         }
-        self.poll_details_collection.insert_one(document)
-
-    def get_poll_details(self, poll_id: str):
-        return self.poll_details_collection.find_one({"poll_id": poll_id})
-    
-    def get_latest_poll_number(self):
-        latest_poll = self.poll_details_collection.find_one(
-            {}, 
+
+    async def store_poll_details(self, poll_number: int, poll_id: str, question: str, options: list):
+        await self.poll_details_collection.insert_one(self.poll_details_document(poll_number, poll_id, question, options))
+
+    async def store_poll_details_many(self, documents: list):
+        # Batched counterpart of store_poll_details, fed by the poll fan-out's write buffer
+        if documents:
+            try:
+                await self.poll_details_collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Duplicate poll ids were written by an earlier attempt of this batch; anything else is an error
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+
+    def cache_poll_details(self, document: dict):
+        self.poll_details_cache[document["poll_id"]] = document
+
+    async def get_poll_details(self, poll_id: str):
+        document = self.poll_details_cache.get(poll_id)
+        if document is None:
+            document = await self.poll_details_collection.find_one({"poll_id": poll_id})
+        return document
+
+    async def get_latest_poll_number(self):
+        latest_poll = await self.poll_details_collection.find_one(
+            {},
             sort=[("poll_number", -1)]
         )
         return latest_poll["poll_number"] if latest_poll else 0
 
-
-
-    
-    def store_poll_response(self, poll_number: int, poll_id: str, user_id: int, student_answer: str,
+    async def store_poll_response(self, poll_number: int, poll_id: str, user_id: int, student_answer: str,
                         question: str, timestamp: datetime):
-        document = {
+        document = self.poll_response_document(poll_number, poll_id, user_id, student_answer, question, timestamp)
+        await self.poll_responses_collection.insert_one(document)
+
+    def poll_response_document(self, poll_number: int, poll_id: str, user_id: int, student_answer: str,
+                               question: str, timestamp: datetime):
+        return {
             "poll_number": poll_number,
             "poll_id": poll_id,
             "user_id": user_id,
@@ -234,107 +595,258 @@ class Chat_DB:
             "student_answer": student_answer,
             "timestamp": timestamp
         }
-        self.poll_responses_collection.insert_one(document)
 
+    async def store_poll_answers(self, documents: list):
+        """
+        Batched counterpart of store_poll_response followed by remove_poll_details.
+        Responses are upserted by poll_id, so a batch that is retried after a partial failure is not duplicated.
+        """
+        if not documents:
+            return
+
+        await self.poll_responses_collection.bulk_write(
+            [UpdateOne({"poll_id": document["poll_id"]}, {"$setOnInsert": document}, upsert=True) for document in documents],
+            ordered=False
+        )
+        poll_ids = list(dict.fromkeys(document["poll_id"] for document in documents))
+        await self.poll_details_collection.bulk_write([DeleteOne({"poll_id": poll_id}) for poll_id in poll_ids], ordered=False)
+
+        for poll_id in poll_ids:
+            self.poll_details_cache.pop(poll_id, None)
+
+    def export_query(self, user_field: str, date_field: str = None, filters: dict = None, allowed: tuple = ()):
+        """
+        Builds the query of a filtered export. filters may hold date_from / date_to (datetimes, date_to
+        exclusive), user_ids and any of the collection-specific keys in allowed (e.g. poll_number, sentiment).
+        Dates are naive datetimes in the server's local time, like the stored timestamps. They are matched
+        on date_field, or on the creation time in _id when date_field is None.
+        """
+        filters = filters or {}
+        unsupported = set(filters) - {"date_from", "date_to", "user_ids"} - set(allowed)
+        if unsupported:
+            raise ValueError(f"Unsupported filter(s) for this export: {', '.join(sorted(unsupported))}")
+
+        query = {}
+        if filters.get("user_ids"):
+            query[user_field] = {"$in": [int(user_id) for user_id in filters["user_ids"]]}
+
+        def bound(value):
+            # date_field values are naive local times (datetime.now()); _id times are UTC, so a local
+            # date is converted first to select the same window in every export
+            return value if date_field else ObjectId.from_datetime(value.astimezone(timezone.utc))
+
+        date_range = {}
+        if filters.get("date_from"):
+            date_range["$gte"] = bound(filters["date_from"])
+        if filters.get("date_to"):
+            date_range["$lt"] = bound(filters["date_to"])
+        if date_range:
+            query[date_field or "_id"] = date_range
+
+        for key in allowed:
+            if filters.get(key) != None:
+                query[key] = filters[key]
+
+        return query
+
+    async def infer_export_schema(self, collection, query: dict = None, sample_size: int = None, projection: dict = None):
+        """
+        Union of the top-level field names of a bounded random sample of the matching documents,
+        ordered by where they first appear in a document. Only field names leave the server.
+        """
+        pipeline = [
+            {"$match": query or {}},
+            {"$sample": {"size": sample_size if sample_size != None else EXPORT_SCHEMA_SAMPLE}},
+        ]
+        if projection:
+            pipeline.append({"$project": projection})
+        pipeline += [
+            {"$project": {"_id": 0, "keys": {"$map": {"input": {"$objectToArray": "$$ROOT"}, "in": "$$this.k"}}}},
+            {"$unwind": {"path": "$keys", "includeArrayIndex": "position"}},
+            {"$group": {"_id": "$keys", "position": {"$min": "$position"}}},
+            {"$sort": {"position": 1, "_id": 1}},
+        ]
+        cursor = await collection.aggregate(pipeline)
+        return [document["_id"] async for document in cursor]
+
+    def export_projection(self, fields: list = None):
+        # Server-side projection of an export; _id is only included when asked for
+        if not fields:
+            return None
+        projection = {field: 1 for field in fields}
+        if "_id" not in projection:
+            projection["_id"] = 0
+        return projection
+
+    async def _export_collection_to_csv(self, collection, empty_message: str, query: dict = None, projection: dict = None):
+        """
+        Streams the matching documents into a gzip-compressed CSV held in a spooled temporary file, so
+        memory stays bounded however large the export is. Columns are inferred from a sample; fields
+        outside them are kept as JSON in the _extra column. Returns the file, rewound, for the caller to close.
+        """
+        columns = await self.infer_export_schema(collection, query=query, projection=projection)
+        if not columns:
+            raise Empty_export(empty_message)
+        known = set(columns)
+
+        spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE, mode="w+b")
+        try:
+            with gzip.GzipFile(fileobj=spool, mode="wb") as compressed:
+                with io.TextIOWrapper(compressed, encoding="utf-8", newline="") as text:
+                    writer = csv.writer(text)
+                    writer.writerow(columns + [EXPORT_EXTRA_COLUMN])
+
+                    rows = 0
+                    async for document in collection.find(query or {}, projection):
+                        extra = {key: value for key, value in document.items() if key not in known}
+                        writer.writerow([_csv_value(document.get(column)) for column in columns]
+                                        + [_csv_value(extra) if extra else ""])
+                        rows += 1
+                        # Give up early rather than after building a file that cannot be sent
+                        if rows % EXPORT_SIZE_CHECK_ROWS == 0:
+                            _check_export_size(spool)
+
+            if rows == 0:
+                raise Empty_export(empty_message)
+            _check_export_size(spool)
+        except Exception:
+            spool.close()
+            raise
+
+        logging.info(f"Exported {rows} documents from {collection.name}")
+        spool.seek(0)
+        return spool
+
+    def export_columns(self, schema, fields: list = None):
+        # The typed columns of a Parquet export, narrowed to fields when given
+        if not fields:
+            return schema
+        unknown = set(fields) - set(schema.names)
+        if unknown:
+            raise ValueError(f"Unknown field(s) for this export: {', '.join(sorted(unknown))}. "
+                             f"Available: {', '.join(schema.names)}")
+        return pa.schema([schema.field(name) for name in fields])
+
+    async def _export_collection_to_parquet(self, collection, schema, to_row, empty_message: str, query: dict = None):
+        """
+        Streams the matching documents into a zstd-compressed Parquet file with typed columns, one record
+        batch of EXPORT_BATCH_ROWS rows at a time, held in a spooled temporary file.
+        Returns the file, rewound, for the caller to close.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE, mode="w+b")
+        try:
+            rows = 0
+            batch = []
+            with pq.ParquetWriter(spool, schema, compression="zstd") as writer:
+                async for document in collection.find(query or {}):
+                    row = to_row(document)
+                    batch.append({name: row[name] for name in schema.names})
+                    if len(batch) >= EXPORT_BATCH_ROWS:
+                        writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                        rows += len(batch)
+                        batch = []
+                        _check_export_size(spool)
+                if batch:
+                    writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                    rows += len(batch)
+
+            if rows == 0:
+                raise Empty_export(empty_message)
+            _check_export_size(spool)
+        except Exception:
+            spool.close()
+            raise
+
+        logging.info(f"Exported {rows} documents from {collection.name} to Parquet")
+        spool.seek(0)
+        return spool
+
+    async def export_chat_collection_to_parquet(self, filters: dict = None, fields: list = None):
+        query = self.export_query("SessionId.user_id", filters=filters)
+        schema = self.export_columns(CHAT_EXPORT_SCHEMA, fields)
+        try:
+            return await self._export_collection_to_parquet(self.chat_collection, schema, _chat_export_row,
+                                                            "No chat history to export.", query=query)
+        except (Empty_export, Export_too_large):
+            raise
+        except Exception as e:
+            raise RuntimeError("Failed to export chat collection.") from e
 
-    
-    def export_chat_collection_to_csv(self, file_path: str):
-        # Export the entire chat collection to a CSV file.
+    async def export_poll_responses_collection_to_parquet(self, filters: dict = None, fields: list = None):
+        query = self.export_query("user_id", date_field="timestamp", filters=filters, allowed=("poll_number",))
+        schema = self.export_columns(POLL_EXPORT_SCHEMA, fields)
         try:
-            with open(file_path, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                # Write header row based on the keys of the documents
-                cursor = self.chat_collection.find()
-                first_doc = next(cursor, None)
-                if not first_doc:
-                    raise ValueError("No chat history to export.")
-                
-                headers = first_doc.keys()
-                writer.writerow(headers)
-                # Write data rows
-                writer.writerow(first_doc.values())
-                for document in cursor:
-                    writer.writerow(document.values())
+            return await self._export_collection_to_parquet(self.poll_responses_collection, schema, _poll_export_row,
+                                                            "No poll responses to export.", query=query)
+        except (Empty_export, Export_too_large):
+            raise
+        except Exception as e:
+            raise RuntimeError("Failed to export poll responses collection.") from e
+
+    # Every export accepts the filters described in export_query and a list of fields to project
 
+    async def export_chat_collection_to_csv(self, filters: dict = None, fields: list = None):
+        query = self.export_query("SessionId.user_id", filters=filters)
+        try:
+            return await self._export_collection_to_csv(self.chat_collection, "No chat history to export.",
+                                                        query=query, projection=self.export_projection(fields))
+        except (Empty_export, Export_too_large):
+            raise
         except Exception as e:
             raise RuntimeError("Failed to export chat collection.") from e
-        
-    def export_feedback_collection_to_csv(self, file_path: str):
-        # Export the entire chat collection to a CSV file.
-        try:
-            with open(file_path, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                # Write header row based on the keys of the documents
-                cursor = self.feedback_collection.find()
-                first_doc = next(cursor, None)
-                if not first_doc:
-                    raise ValueError("No teach feedback to export.")
-                
-                headers = first_doc.keys()
-                writer.writerow(headers)
-                # Write data rows
-                writer.writerow(first_doc.values())
-                for document in cursor:
-                    writer.writerow(document.values())
 
+    async def export_feedback_collection_to_csv(self, filters: dict = None, fields: list = None):
+        query = self.export_query("user_id", filters=filters, allowed=("sentiment",))
+        try:
+            return await self._export_collection_to_csv(self.feedback_collection, "No teach feedback to export.",
+                                                        query=query, projection=self.export_projection(fields))
+        except (Empty_export, Export_too_large):
+            raise
         except Exception as e:
             raise RuntimeError("Failed to export teach feedback collection.") from e
-        
-    def export_poll_responses_collection_to_csv(self, file_path: str):
+
+    async def export_poll_responses_collection_to_csv(self, filters: dict = None, fields: list = None):
+        query = self.export_query("user_id", date_field="timestamp", filters=filters, allowed=("poll_number",))
         try:
-            with open(file_path, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                cursor = self.poll_responses_collection.find()
-                first_doc = next(cursor, None)
-                if not first_doc:
-                    raise ValueError("No poll responses to export.")
-                headers = list(first_doc.keys())
-                writer.writerow(headers)
-                writer.writerow(list(first_doc.values()))
-                for document in cursor:
-                    writer.writerow(list(document.values()))
+            return await self._export_collection_to_csv(self.poll_responses_collection, "No poll responses to export.",
+                                                        query=query, projection=self.export_projection(fields))
+        except (Empty_export, Export_too_large):
+            raise
         except Exception as e:
             raise RuntimeError("Failed to export poll responses collection.") from e
-        
-    def export_users_collection_to_csv(self, file_path: str):
+
+    async def export_users_collection_to_csv(self, filters: dict = None, fields: list = None):
+        query = self.export_query("user_id", filters=filters)
         try:
-            with open(file_path, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                cursor = self.users_collection.find()
-                first_doc = next(cursor, None)
-                if not first_doc:
-                    raise ValueError("No users to export.")
-                headers = list(first_doc.keys())
-                writer.writerow(headers)
-                writer.writerow(list(first_doc.values()))
-                for document in cursor:
-                    writer.writerow(list(document.values()))
+            return await self._export_collection_to_csv(self.users_collection, "No users to export.",
+                                                        query=query, projection=self.export_projection(fields))
+        except (Empty_export, Export_too_large):
+            raise
         except Exception as e:
             raise RuntimeError("Failed to export users collection.") from e
-        
 
-    def store_ils_answer(self, user_id: int, question_index: int, answer: str):
+    async def store_ils_answer(self, user_id: int, question_index: int, answer: str):
         doc = {
             "user_id": user_id,
             "question_index": question_index,
             "answer": answer,
             "timestamp": datetime.now()
         }
-        self.db["ils_answers"].update_one(
+        await self.db["ils_answers"].update_one(
             {"user_id": user_id, "question_index": question_index},
             {"$set": doc},
             upsert=True
         )
 
-    def get_ils_answers(self, user_id: int):
+    async def get_ils_answers(self, user_id: int):
         cursor = self.db["ils_answers"].find({"user_id": user_id}).sort("question_index", 1)
-        return [doc["answer"] for doc in cursor]
+        return [doc["answer"] async for doc in cursor]
 
-    def clear_ils_answers(self, user_id: int):
-        self.db["ils_answers"].delete_many({"user_id": user_id})
+    async def clear_ils_answers(self, user_id: int):
+        await self.db["ils_answers"].delete_many({"user_id": user_id})
 
-    def authenticate_user(self, user_id: int):
-        self.users_collection.update_one(
+    async def authenticate_user(self, user_id: int):
+        await self.users_collection.update_one(
             {"user_id": user_id},  # Search for existing user
             {
                 "$set": {
@@ -345,22 +857,151 @@ class Chat_DB:
             },
             upsert=True  # Insert if user does not exist
         )
+        self.invalidate_user(user_id)
 
-    def remove_poll_details(self, poll_id: str):
-        self.poll_details_collection.delete_one({"poll_id": poll_id})
-
-
+    async def store_start_ils_analysis(self, user_id: int, ils_analysis: dict):
+        # Learning style results from the ILS questionnaire
+        await self.users_collection.update_one(
+            {"user_id": user_id},
+            {"$set": {"start_ils_analysis": ils_analysis}}
+        )
+        self.invalidate_user(user_id)
 
+    async def store_chat_ils_analysis(self, user_id: int, ils_analysis: dict):
+        # Learning style results inferred from the chat history
+        await self.users_collection.update_one(
+            {"user_id": user_id},
+            {"$set": {"chat_ils_analysis": ils_analysis}}
+        )
+        self.invalidate_user(user_id)
 
+    async def remove_poll_details(self, poll_id: str):
+        await self.poll_details_collection.delete_one({"poll_id": poll_id})
+        self.poll_details_cache.pop(poll_id, None)
 
+    async def start_broadcast(self, job_id: str, description: str, recipients: list, payload: dict = None):
+        # Create the broadcast record, or pick up an interrupted one; returns the chat ids already handled
+        document = await self.broadcasts_collection.find_one_and_update(
+            {"_id": job_id},
+            {
+                "$setOnInsert": {
+                    "description": description,
+                    "recipients": recipients,
+                    "payload": payload,
+                    "delivered": [],
+                    "created": datetime.now(),
+                },
+                "$set": {"status": "running"},
+            },
+            projection={"delivered": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return set(document.get("delivered", []))
 
+    async def mark_broadcast_delivered(self, job_id: str, chat_ids: list):
+        await self.broadcasts_collection.update_one(
+            {"_id": job_id},
+            {"$addToSet": {"delivered": {"$each": chat_ids}}}
+        )
 
+    async def mark_broadcast_step(self, job_id: str, chat_id: int, step: int):
+        # Per-chat progress of a broadcast that sends several messages to each chat
+        await self.broadcasts_collection.update_one({"_id": job_id}, {"$set": {f"steps.{chat_id}": step}})
 
+    async def get_broadcast_steps(self, job_id: str):
+        document = await self.broadcasts_collection.find_one({"_id": job_id}, {"steps": 1})
+        return {int(chat_id): step for chat_id, step in ((document or {}).get("steps") or {}).items()}
 
+    async def finish_broadcast(self, job_id: str, summary: dict):
+        await self.broadcasts_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "done", "summary": summary, "finished": datetime.now()}}
+        )
 
+    async def get_unfinished_broadcasts(self):
+        cursor = self.broadcasts_collection.find({"status": "running"}, {"delivered": 0, "steps": 0})
+        return [document async for document in cursor]
 
+    async def start_analysis_run(self, run_id: str):
+        # Start a batch analysis, or resume the unfinished one; returns the user ids already completed
+        document = await self.analysis_runs_collection.find_one({"_id": run_id})
+        if document and document.get("status") == "running":
+            return set(document.get("completed", []))
 
+        await self.analysis_runs_collection.update_one(
+            {"_id": run_id},
+            {
+                "$set": {"status": "running", "completed": [], "started": datetime.now()},
+                "$unset": {"summary": "", "finished": ""},
+            },
+            upsert=True
+        )
+        return set()
 
-        
+    async def mark_analysis_completed(self, run_id: str, user_ids: list):
+        await self.analysis_runs_collection.update_one(
+            {"_id": run_id},
+            {"$addToSet": {"completed": {"$each": user_ids}}}
+        )
 
+    async def finish_analysis_run(self, run_id: str, summary: dict):
+        await self.analysis_runs_collection.update_one(
+            {"_id": run_id},
+            {"$set": {"status": "done", "summary": summary, "finished": datetime.now()}}
+        )
 
+    async def get_learning_style_state(self, user_id: int):
+        # Returns the stored incremental learning style analysis, or None before the first /analyse
+        return await self.learning_style_collection.find_one({"_id": int(user_id)})
+
+    async def store_learning_style_state(self, user_id: int, state: dict):
+        state = {key: value for key, value in state.items() if key != "_id"}
+        await self.learning_style_collection.replace_one({"_id": int(user_id)}, state, upsert=True)
+
+    async def get_misconception_checkpoint(self, user_id: int):
+        # _id of the last message analysed for misconceptions, or None if the user was never analysed
+        document = await self.misconception_state_collection.find_one({"_id": int(user_id)})
+        return document["last_message_id"] if document else None
+
+    async def get_misconceptions(self, user_id: int):
+        cursor = self.misconceptions_collection.find({"user_id": int(user_id)}).sort("first_message_id", 1)
+        return [document async for document in cursor]
+
+    async def store_misconceptions(self, user_id: int, findings: list, first_message_id: ObjectId, last_message_id: ObjectId):
+        """
+        Merges findings from the messages first_message_id..last_message_id into the stored ones, one
+        document per topic, and moves the checkpoint to last_message_id.
+        """
+        now = datetime.now()
+        operations = []
+        # findings are normalized by misconception_module.normalize_findings
+        for finding in findings:
+            topic = finding["topic"]
+            operations.append(UpdateOne(
+                {"user_id": int(user_id), "topic_key": topic.lower()},
+                {
+                    "$set": {
+                        "topic": topic,
+                        "description": finding["description"],
+                        "correction": finding["correction"],
+                        "recommendations": finding["recommendations"],
+                        "resolved": finding["resolved"],
+                        "updated": now,
+                    },
+                    "$push": {"examples": {"$each": finding["examples"], "$slice": -5}},
+                    "$min": {"first_message_id": first_message_id},
+                    "$max": {"last_message_id": last_message_id},
+                    "$setOnInsert": {"detected": now},
+                },
+                upsert=True
+            ))
+
+        if operations:
+            await self.misconceptions_collection.bulk_write(operations, ordered=False)
+
+        await self.misconception_state_collection.update_one(
+            {"_id": int(user_id)},
+            {"$set": {"last_message_id": last_message_id, "updated": now}},
+            upsert=True
+        )
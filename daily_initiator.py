@@ -2,13 +2,17 @@ import random
 from datetime import datetime
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+import history_window
+
+STARTER_TOKEN_BUDGET = 1000 # Tokens of recent history used to personalise the starter
 
 class DailyConversationInitiator:
 
-    def __init__(self, llm, database):
+    def __init__(self, llm, database, history = None):
 
         self.llm = llm
         self.database = database
+        self.history = history if history != None else history_window.History_window(llm=llm, database=database)
 
         # Define a prompt that instructs the LLM to generate a creative conversation starter
         self.initiation_prompt = ChatPromptTemplate.from_messages([
@@ -30,28 +34,24 @@ class DailyConversationInitiator:
 
     async def initiate_conversation(self, user_id: str) -> str:
         """
-        Retrieves the last 10 messages from the most recent conversation for the given user,
+        Retrieves the latest messages that fit STARTER_TOKEN_BUDGET from the most recent conversation,
         generates a conversation starter using the LLM, and returns the generated prompt.
         """
 
         # Get the most recent conversation ID for the user.
-        recent_convo_id = self.database.get_recent_conversation(user_id)
-        messages = []
+        recent_convo_id = await self.database.get_recent_conversation(user_id)
+        recent_messages = []
         if recent_convo_id:
-            # Retrieve messages from the most recent conversation.
-            messages.extend(self.database.get_by_session_id(user_id, recent_convo_id).messages)
-            # Use the last 10 messages if available.
-            last_ten_messages = messages[-5:] if messages else []
-        else:
-            last_ten_messages = []
+            # Retrieve only the latest messages of the most recent conversation that fit the token budget.
+            recent_messages = await self.history.load(user_id, recent_convo_id, max_tokens=STARTER_TOKEN_BUDGET, summarize=False)
 
-        chat_history_text = last_ten_messages if last_ten_messages else "No previous messages available."
+        chat_history_text = recent_messages if recent_messages else "No previous messages available."
 
         # Get the current time to add temporal context.
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         # Invoke the chain to generate a conversation starter, providing both chat history and datetime.
-        result = self.initiation_chain.invoke({
+        result = await self.initiation_chain.ainvoke({
             "chat_history": chat_history_text,
             "datetime": current_time
         })
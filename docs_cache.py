@@ -0,0 +1,127 @@
+# importing os module for environment variables
+import os
+# importing necessary functions from dotenv library
+from dotenv import load_dotenv
+
+import hashlib
+import json
+import logging
+import tempfile
+
+load_dotenv() # Load environment variables from .env file
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+DOCS_CACHE_PATH = os.environ.get('DOCS_CACHE_PATH', 'docs_cache')
+DOCS_CACHE_MAX_BYTES = int(os.environ.get('DOCS_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+class Docs_cache:
+    """
+    Content-addressed, size-bounded disk cache of extracted document text.
+
+    Extracted (page_number, text) sections are stored once per SHA-256 of the file content. Telegram's
+    file_unique_id is recorded as an alias of that hash, so a repeat upload of the same file is served
+    without downloading or parsing it. Entries are evicted least-recently-used once the cache exceeds
+    max_bytes. Chunks are derived deterministically from the cached sections by Docs_index.
+    """
+    def __init__(self, path: str = None, max_bytes: int = None):
+
+        self.path = path if path != None else DOCS_CACHE_PATH
+        self.max_bytes = max_bytes if max_bytes != None else DOCS_CACHE_MAX_BYTES
+
+        self.content_dir = os.path.join(self.path, "content")
+        self.alias_dir = os.path.join(self.path, "ids")
+        os.makedirs(self.content_dir, exist_ok=True)
+        os.makedirs(self.alias_dir, exist_ok=True)
+
+    def _content_path(self, digest: str):
+        return os.path.join(self.content_dir, f"{digest}.json")
+
+    def _alias_path(self, file_unique_id: str):
+        return os.path.join(self.alias_dir, file_unique_id)
+
+    def _write_atomic(self, path: str, data: str):
+        # Write to a temp file in the same directory and rename, so readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def hash_file(file_path):
+        # file_path may also be the file's raw bytes
+        if isinstance(file_path, (bytes, bytearray)):
+            return hashlib.sha256(file_path).hexdigest()
+
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get_by_hash(self, digest: str):
+        # Returns the cached [(page_number, text), ...] for this content, or None
+        content_path = self._content_path(digest)
+        try:
+            with open(content_path, "r", encoding="utf-8") as f:
+                pages = json.load(f)["pages"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+        os.utime(content_path) # Mark as recently used
+        return [(page_number, text) for page_number, text in pages]
+
+    def get_by_file_id(self, file_unique_id: str):
+        try:
+            with open(self._alias_path(file_unique_id), "r", encoding="utf-8") as f:
+                digest = f.read().strip()
+        except FileNotFoundError:
+            return None
+
+        pages = self.get_by_hash(digest)
+        if pages is None:
+            # Content was evicted; drop the dangling alias
+            self._remove(self._alias_path(file_unique_id))
+        return pages
+
+    def put(self, digest: str, pages, file_unique_id: str = None):
+        if not os.path.exists(self._content_path(digest)):
+            self._write_atomic(self._content_path(digest), json.dumps({"pages": list(pages)}))
+            self.evict()
+        if file_unique_id:
+            self.add_alias(file_unique_id, digest)
+
+    def add_alias(self, file_unique_id: str, digest: str):
+        self._write_atomic(self._alias_path(file_unique_id), digest)
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits in max_bytes
+        entries = []
+        for entry in os.scandir(self.content_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            logging.info(f"Evicted cached document {path}")
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,127 @@
+# importing os module for environment variables
+import os
+# importing necessary functions from dotenv library
+from dotenv import load_dotenv
+
+import hashlib
+import logging
+import chromadb
+from chromadb.config import Settings
+from chromadb.utils import embedding_functions
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+load_dotenv() # Load environment variables from .env file
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+DOCS_INDEX_PATH = os.environ.get('DOCS_INDEX_PATH', 'docs_index')
+DOCS_CHUNK_SIZE = int(os.environ.get('DOCS_CHUNK_SIZE', 1000)) # Characters per chunk
+DOCS_CHUNK_OVERLAP = int(os.environ.get('DOCS_CHUNK_OVERLAP', 150))
+DOCS_TOP_K = int(os.environ.get('DOCS_TOP_K', 5)) # Chunks retrieved per query
+
+UPSERT_BATCH_SIZE = 512
+
+class Docs_index:
+    """
+    Per-user retrieval index over uploaded documents.
+
+    Documents are split into overlapping chunks and stored in an on-disk Chroma collection per user,
+    embedded with Chroma's local default embedding model. Each query only retrieves the top-k
+    chunks, so the prompt context stays bounded regardless of how much a user uploads.
+    """
+    def __init__(self, path: str = None, chunk_size: int = None, chunk_overlap: int = None, top_k: int = None):
+
+        self.path = path if path != None else DOCS_INDEX_PATH
+        self.top_k = top_k if top_k != None else DOCS_TOP_K
+
+        # Uploads belong to students, so nothing is reported to Chroma's telemetry
+        self.client = chromadb.PersistentClient(path=self.path, settings=Settings(anonymized_telemetry=False))
+        # Pinned so every collection uses the same model; see warm_up()
+        self.embedding_function = embedding_functions.DefaultEmbeddingFunction()
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size if chunk_size != None else DOCS_CHUNK_SIZE,
+            chunk_overlap=chunk_overlap if chunk_overlap != None else DOCS_CHUNK_OVERLAP,
+        )
+
+    def warm_up(self):
+        # Downloads and loads the embedding model at startup instead of inside the first user's request
+        self.embedding_function(["warm up"])
+        logging.info("Document embedding model loaded")
+
+    def _collection_name(self, user_id: int):
+        return f"user_{user_id}"
+
+    def _collection(self, user_id: int):
+        return self.client.get_or_create_collection(
+            name=self._collection_name(user_id),
+            metadata={"hnsw:space": "cosine"},
+            embedding_function=self.embedding_function,
+        )
+
+    def _existing_collection(self, user_id: int):
+        # Reads must not create a collection for every user who chats without uploading anything
+        try:
+            return self.client.get_collection(name=self._collection_name(user_id), embedding_function=self.embedding_function)
+        except Exception:
+            return None # Nothing indexed for this user (the exception type differs across chromadb versions)
+
+    def add_document(self, user_id: int, file_name: str, pages):
+        """
+        Chunks a document and adds it to the user's index, replacing an earlier upload of the same file.
+        pages is either the full text or an iterable of (page_number, text), such as
+        Docs_processor.iter_document(); it is consumed lazily and written in batches.
+        Returns the number of chunks stored.
+        """
+        if isinstance(pages, str):
+            pages = [(1, pages)]
+
+        collection = self._collection(user_id)
+        collection.delete(where={"file_name": file_name})
+
+        name_digest = hashlib.sha1(file_name.encode("utf-8")).hexdigest()[:16]
+        batch = []
+        count = 0
+
+        def flush():
+            collection.upsert(
+                ids=[chunk_id for chunk_id, _, _ in batch],
+                documents=[chunk for _, chunk, _ in batch],
+                metadatas=[metadata for _, _, metadata in batch],
+            )
+            batch.clear()
+
+        for page_number, text in pages:
+            for i, chunk in enumerate(self.splitter.split_text(text)):
+                batch.append((f"{name_digest}-{page_number}-{i}", chunk, {"file_name": file_name, "page": page_number}))
+                count += 1
+                if len(batch) >= UPSERT_BATCH_SIZE:
+                    flush()
+        if batch:
+            flush()
+
+        logging.info(f"Indexed {count} chunks of {file_name} for user {user_id}")
+        return count
+
+    def query(self, user_id: int, query: str, top_k: int = None):
+        # Retrieve the chunks most relevant to the query, formatted as prompt context
+        collection = self._existing_collection(user_id)
+        if collection == None:
+            return ""
+        count = collection.count()
+        if count == 0:
+            return ""
+
+        result = collection.query(query_texts=[query], n_results=min(top_k or self.top_k, count))
+
+        return "".join(
+            f"{metadata['file_name']} (page {metadata.get('page', 1)}):\n{document}\n\n"
+            for document, metadata in zip(result["documents"][0], result["metadatas"][0])
+        )
+
+    def clear(self, user_id: int):
+        if self._existing_collection(user_id) == None:
+            return
+        self.client.delete_collection(name=self._collection_name(user_id))
@@ -1,3 +1,10 @@
+import os
+import io
+import asyncio
+from contextlib import contextmanager
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import PyPDF2
 import logging
 import json
@@ -13,11 +20,156 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+DOCS_WORKERS = int(os.environ.get('DOCS_WORKERS', 2)) # Parser processes
+DOCS_TIMEOUT = float(os.environ.get('DOCS_TIMEOUT', 60)) # Seconds allowed per file
+DOCS_MAX_BYTES = int(os.environ.get('DOCS_MAX_BYTES', 20 * 1024 * 1024)) # Largest file handed to a parser
+DOCS_WORKER_MEMORY = int(os.environ.get('DOCS_WORKER_MEMORY', 2048)) * 1024 * 1024 # Address space cap per parser process
+DOCS_MAX_PAGES = int(os.environ.get('DOCS_MAX_PAGES', 500)) # Pages read from a PDF before stopping
+DOCS_MAX_CHARS = int(os.environ.get('DOCS_MAX_CHARS', 2_000_000)) # Characters extracted from one document
+
+
+def _limit_memory(max_bytes: int):
+    # Runs in each worker so that a pathological file fails with MemoryError instead of exhausting the host
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+    except (ImportError, ValueError, OSError) as e:
+        logging.warning(f"Could not limit parser memory: {e}")
+
+
+@contextmanager
+def _open_binary(source):
+    # Documents may be given as a path, raw bytes or a binary file-like object
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            yield f
+    elif isinstance(source, (bytes, bytearray)):
+        yield io.BytesIO(source)
+    else:
+        source.seek(0)
+        yield source
+
+
+def _describe(source):
+    # Printable name of a document source for logs and error messages
+    return os.fspath(source) if isinstance(source, (str, os.PathLike)) else "<in-memory document>"
+
+
+def _source_size(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    return source.getbuffer().nbytes if isinstance(source, io.BytesIO) else None
+
+
+def _extract(file_path, file_type: str):
+    # Module-level so it can be pickled into the process pool; the page generator is drained
+    # here because generators cannot cross the process boundary (the page/char budget bounds it)
+    return list(Docs_processor().iter_document(file_path=file_path, file_type=file_type))
+
+
 class Docs_processor:
-    def __init__(self):
-        pass
+    def __init__(self, max_workers: int = None, timeout: float = None, max_bytes: int = None, worker_memory: int = None,
+                 max_pages: int = None, max_chars: int = None):
+
+        self.max_workers = max_workers if max_workers != None else DOCS_WORKERS
+        self.timeout = timeout if timeout != None else DOCS_TIMEOUT
+        self.max_bytes = max_bytes if max_bytes != None else DOCS_MAX_BYTES
+        self.worker_memory = worker_memory if worker_memory != None else DOCS_WORKER_MEMORY
+        self.max_pages = max_pages if max_pages != None else DOCS_MAX_PAGES
+        self.max_chars = max_chars if max_chars != None else DOCS_MAX_CHARS
+
+        self._pool = None # Created on first async use
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                # spawn: don't fork the bot's threads (event loop, Mongo monitors) into the workers
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_limit_memory,
+                initargs=(self.worker_memory,),
+            )
+        return self._pool
 
-    def load_document(self, file_path: str, file_type: str):
+    def _recycle_pool(self, pool = None):
+        # A timed-out parser cannot be cancelled, so its pool is torn down and rebuilt on next use.
+        # Files still being parsed by the old pool fail with BrokenProcessPool and are retried once
+        if pool is None:
+            pool = self._pool
+        if pool is None or pool is not self._pool:
+            return # Already replaced by another caller
+        self._pool = None
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def aload_pages(self, file_path, file_type: str):
+        """
+        Parses a document in the process pool without blocking the event loop and returns its
+        (page_number, text) sections, as produced by iter_document. file_path may also be raw
+        bytes or a binary file-like object.
+        Raises ValueError if the file is too large, takes longer than the timeout, or fails to parse.
+        If the pool breaks while the file is being parsed, it is retried once on a fresh pool.
+        """
+        if not isinstance(file_path, (str, os.PathLike, bytes, bytearray)):
+            # Only paths and bytes can be sent to a worker process
+            with _open_binary(file_path) as f:
+                file_path = f.read()
+
+        file_size = _source_size(file_path)
+        if file_size > self.max_bytes:
+            raise ValueError(f"File too large to process ({file_size} bytes): {_describe(file_path)}")
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            pool = self._get_pool()
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(pool, _extract, file_path, file_type),
+                    timeout=self.timeout,
+                )
+            except asyncio.TimeoutError:
+                logging.error(f"Timed out after {self.timeout}s processing {_describe(file_path)}")
+                self._recycle_pool(pool)
+                raise ValueError(f"Timed out processing file: {_describe(file_path)}")
+            except BrokenProcessPool:
+                # A worker died (memory limit, OOM kill) or the pool was recycled after another file
+                # timed out; a broken pool never recovers, so it is replaced before retrying
+                self._recycle_pool(pool)
+                if attempt == 0:
+                    logging.warning(f"Parser pool broke while processing {_describe(file_path)}, retrying")
+                    continue
+                raise ValueError(f"Parser crashed processing file: {_describe(file_path)}")
+            except MemoryError:
+                raise ValueError(f"Ran out of memory processing file: {_describe(file_path)}")
+
+    async def aload_document(self, file_path, file_type: str):
+        # Same as aload_pages, joined into a single string like load_document
+        return "".join(text for _, text in await self.aload_pages(file_path, file_type))
+
+    async def aload_documents(self, files: list):
+        """
+        Parses several (file_path, file_type) pairs concurrently and yields
+        (file_path, pages, error) tuples in the order they finish.
+        """
+        async def load(file_path, file_type):
+            try:
+                return file_path, await self.aload_pages(file_path, file_type), None
+            except Exception as e:
+                return file_path, None, e
+
+        for task in asyncio.as_completed([load(file_path, file_type) for file_path, file_type in files]):
+            yield await task
+
+    def load_document(self, file_path, file_type: str):
+        # file_path may be a path, raw bytes or a binary file-like object
         # Determine file type and process accordingly
         match file_type:
             case "pdf":
@@ -25,95 +177,122 @@ class Docs_processor:
                     text = self.process_pdf(file_path)
                 except Exception as e:
                     logging.error(f"Error loading PDF file: {e}")
-                    raise ValueError(f"Failed to process PDF file: {file_path}")
+                    raise ValueError(f"Failed to process PDF file: {_describe(file_path)}")
             case "docx":
                 try:
                     text = self.process_docx(file_path)
                 except Exception as e:
                     logging.error(f"Error loading DOCX file: {e}")
-                    raise ValueError(f"Failed to process DOCX file: {file_path}")
+                    raise ValueError(f"Failed to process DOCX file: {_describe(file_path)}")
             case "json":
                 try:
                     text = self.process_json(file_path)
                 except Exception as e:
                     logging.error(f"Error loading JSON file: {e}")
-                    raise ValueError(f"Failed to process JSON file: {file_path}")
+                    raise ValueError(f"Failed to process JSON file: {_describe(file_path)}")
             case "html" | "htm":
                 try:
                     text = self.process_html(file_path)
                 except Exception as e:
                     logging.error(f"Error loading HTML file: {e}")
-                    raise ValueError(f"Failed to process HTML file: {file_path}")
+                    raise ValueError(f"Failed to process HTML file: {_describe(file_path)}")
             case "xml":
                 try:
                     text = self.process_xml(file_path)
                 except Exception as e:
                     logging.error(f"Error loading XML file: {e}")
-                    raise ValueError(f"Failed to process XML file: {file_path}")
+                    raise ValueError(f"Failed to process XML file: {_describe(file_path)}")
             case "xlsx":
                 try:
                     text = self.process_xlsx(file_path)
                 except Exception as e:
                     logging.error(f"Error loading XLSX file: {e}")
-                    raise ValueError(f"Failed to process XLSX file: {file_path}")
+                    raise ValueError(f"Failed to process XLSX file: {_describe(file_path)}")
             case "xls":
                 try:
                     text = self.process_xls(file_path)
                 except Exception as e:
                     logging.error(f"Error loading XLS file: {e}")
-                    raise ValueError(f"Failed to process XLS file: {file_path}")
+                    raise ValueError(f"Failed to process XLS file: {_describe(file_path)}")
             case "ipynb":
                 try:
                     text = self.process_ipynb(file_path)
                 except Exception as e:
                     logging.error(f"Error loading IPYNB file: {e}")
-                    raise ValueError(f"Failed to process IPYNB file: {file_path}")
+                    raise ValueError(f"Failed to process IPYNB file: {_describe(file_path)}")
             case "pptx":
                 try:
                     text = self.process_pptx(file_path)
                 except Exception as e:
                     logging.error(f"Error loading PPTX file: {e}")
-                    raise ValueError(f"Failed to process PPTX file: {file_path}")
+                    raise ValueError(f"Failed to process PPTX file: {_describe(file_path)}")
                 
             case _:
                 try:
                     text = self.process_text_file(file_path)
                 except Exception as e:
                     logging.error(f"Error loading text file: {e}")
-                    raise ValueError(f"Failed to process text file: {file_path}")
+                    raise ValueError(f"Failed to process text file: {_describe(file_path)}")
         return text
 
-    def process_pdf(self, file_path):
-        text = ""
-        with open(file_path, "rb") as pdf_file:
+    def iter_document(self, file_path, file_type: str):
+        """
+        Yields the document as (page_number, text) sections within the max_chars budget.
+        PDFs are streamed page by page; other formats are a single section numbered 1.
+        """
+        if file_type == "pdf":
+            try:
+                yield from self.iter_pdf_pages(file_path)
+            except Exception as e:
+                logging.error(f"Error loading PDF file: {e}")
+                raise ValueError(f"Failed to process PDF file: {_describe(file_path)}")
+        else:
+            yield 1, self.load_document(file_path=file_path, file_type=file_type)[:self.max_chars]
+
+    def iter_pdf_pages(self, file_path, max_pages: int = None, max_chars: int = None):
+        # Lazily yields (page_number, text) in page order, stopping once the page or character budget is spent
+        max_pages = max_pages if max_pages != None else self.max_pages
+        remaining = max_chars if max_chars != None else self.max_chars
+
+        with _open_binary(file_path) as pdf_file:
             reader = PyPDF2.PdfReader(pdf_file)
-            for page in reader.pages:
-                text += page.extract_text()
-        return text
+            for page_number, page in enumerate(reader.pages, start=1):
+                if page_number > max_pages or remaining <= 0:
+                    logging.info(f"Stopped reading {_describe(file_path)} at page {page_number - 1} (budget reached)")
+                    return
+                text = (page.extract_text() or "")[:remaining]
+                remaining -= len(text)
+                yield page_number, text
+
+    def process_pdf(self, file_path):
+        return "".join(text for _, text in self.iter_pdf_pages(file_path))
 
     def process_docx(self, file_path):
-        doc = Document(file_path)
+        with _open_binary(file_path) as f:
+            doc = Document(f)
         text = "\n".join([para.text for para in doc.paragraphs])
         return text
 
     def process_json(self, file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
+        with _open_binary(file_path) as f:
             data = json.load(f)
         return json.dumps(data, indent=4)
 
     def process_html(self, file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
+        with _open_binary(file_path) as f:
             soup = BeautifulSoup(f, "html.parser")
         return soup.get_text(separator="\n")
 
     def process_xml(self, file_path):
-        tree = ET.parse(file_path)
+        with _open_binary(file_path) as f:
+            tree = ET.parse(f)
         root = tree.getroot()
         text = " ".join(root.itertext())
         return text
 
     def process_xlsx(self, file_path):
-        wb = load_workbook(file_path, read_only=True)
+        with _open_binary(file_path) as f:
+            wb = load_workbook(io.BytesIO(f.read()), read_only=True)
         texts = []
         for ws in wb.worksheets:
             for row in ws.iter_rows(values_only=True):
@@ -123,7 +302,8 @@ class Docs_processor:
         return "\n".join(texts)
 
     def process_xls(self, file_path):
-        wb = xlrd.open_workbook(file_path)
+        with _open_binary(file_path) as f:
+            wb = xlrd.open_workbook(file_contents=f.read())
         texts = []
         for sheet in wb.sheets():
             for row in range(sheet.nrows):
@@ -132,7 +312,7 @@ class Docs_processor:
         return "\n".join(texts)
 
     def process_ipynb(self, file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
+        with _open_binary(file_path) as f:
             notebook = json.load(f)
         texts = []
         for cell in notebook.get("cells", []):
@@ -142,7 +322,8 @@ class Docs_processor:
         return "\n".join(texts)
 
     def process_pptx(self, file_path):
-        prs = Presentation(file_path)
+        with _open_binary(file_path) as f:
+            prs = Presentation(f)
         texts = []
         for slide in prs.slides:
             for shape in slide.shapes:
@@ -151,5 +332,5 @@ class Docs_processor:
         return "\n".join(texts)
 
     def process_text_file(self, file_path):
-        with open(file_path, "r", encoding="utf-8") as text_file:
-            return text_file.read()
\ No newline at end of file
+        with _open_binary(file_path) as text_file:
+            return text_file.read().decode("utf-8")
\ No newline at end of file
@@ -0,0 +1,158 @@
+# importing os module for environment variables
+import os
+# importing necessary functions from dotenv library
+from dotenv import load_dotenv
+
+import asyncio
+import contextlib
+import logging
+import tiktoken
+import chat_database
+from typing import Sequence
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+
+load_dotenv() # Load environment variables from .env file
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', 3000)) # Tokens of chat history given to the teacher
+ANALYSIS_TOKEN_BUDGET = int(os.environ.get('ANALYSIS_TOKEN_BUDGET', 12000)) # Tokens of chat history per analysis call
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get('SUMMARY_TRIGGER_TOKENS', 2000)) # Unsummarized tokens outside the window before the summary is updated
+
+SUMMARY_MAX_BATCHES = 3 # Summary updates per background run; a longer backlog is caught up on later loads
+SUMMARY_PAGE_MESSAGES = 200 # Messages read per summary update
+MESSAGE_TOKEN_OVERHEAD = 4 # Role and separator tokens added per chat message
+
+class History_window:
+    """
+    Loads as much recent chat history as fits a token budget, reading only the newest messages from
+    MongoDB. Turns that fall outside the window are folded into a rolling summary, stored per
+    conversation, which is prepended to the window as a system message. The summary is updated in the
+    background once SUMMARY_TRIGGER_TOKENS of unsummarized turns have built up, so replies never wait for it.
+    """
+    def __init__(self, llm, database, max_tokens: int = None, model: str = "gpt-4o", semaphore = None):
+
+        self.llm = llm
+        self.database = database
+        self.max_tokens = max_tokens if max_tokens != None else HISTORY_TOKEN_BUDGET
+
+        # Summary calls count against the caller's LLM concurrency cap when one is given
+        self.semaphore = semaphore if semaphore != None else contextlib.nullcontext()
+        # Background summary updates in flight, at most one per (user_id, conversation_id)
+        self.summary_tasks = {}
+
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base") # Close enough for non-OpenAI models
+
+        self.summary_prompt = ChatPromptTemplate.from_messages([
+            ("system",
+             "You maintain a running summary of a conversation between a learner and an educational chatbot. "
+             "Extend the previous summary with the new messages. Keep the topics covered, the learner's questions, "
+             "difficulties and progress, and anything the chatbot promised to follow up on. "
+             "Write at most 250 words of plain text."),
+            ("human", "Previous summary: {summary}\n\nNew messages: {chat_history}\n\nReturn the updated summary."),
+        ])
+        self.summary_chain = self.summary_prompt | self.llm | StrOutputParser()
+
+    def count_tokens(self, messages) -> int:
+        return sum(len(self.encoding.encode(str(message.content))) + MESSAGE_TOKEN_OVERHEAD for message in messages)
+
+    def fit(self, batch: list, max_tokens: int = None):
+        # Longest prefix of [(message_id, message), ...] that fits max_tokens; never empty if batch is not
+        max_tokens = max_tokens if max_tokens != None else ANALYSIS_TOKEN_BUDGET
+        used = 0
+        for i, (_, message) in enumerate(batch):
+            used += self.count_tokens([message])
+            if i > 0 and used > max_tokens:
+                return batch[:i]
+        return batch
+
+    async def load(self, user_id: int, conversation_id: int = None, max_tokens: int = None, summarize: bool = True):
+        """
+        Returns the newest messages of a conversation (or of all conversations when conversation_id is None)
+        that fit max_tokens, preceded by a summary of the older ones when summarize is set.
+        """
+        messages, oldest_id, has_older = await self.database.get_recent_messages(
+            user_id=user_id,
+            conversation_id=conversation_id,
+            max_tokens=max_tokens if max_tokens != None else self.max_tokens,
+            token_counter=self.count_tokens,
+        )
+
+        if has_older and summarize:
+            # The stored summary is used as it is; bringing it up to date is left to a background task
+            state = await self.database.get_history_summary(user_id=user_id, conversation_id=conversation_id)
+            if state and state.get("summary"):
+                messages.insert(0, SystemMessage(content=f"Summary of the earlier conversation: {state['summary']}"))
+            self.schedule_summary(user_id, conversation_id, before_id=oldest_id)
+
+        return messages
+
+    def schedule_summary(self, user_id: int, conversation_id: int, before_id):
+        key = (user_id, conversation_id)
+        if key in self.summary_tasks:
+            return # Already catching up
+        task = asyncio.create_task(self.summarize_older(user_id, conversation_id, before_id=before_id))
+        self.summary_tasks[key] = task # Also keeps the task from being garbage-collected
+        task.add_done_callback(lambda _: self.summary_tasks.pop(key, None))
+
+    async def summarize_older(self, user_id: int, conversation_id: int, before_id):
+        # Fold messages older than before_id that are not yet summarized into the stored summary, once
+        # there are at least SUMMARY_TRIGGER_TOKENS of them
+        try:
+            state = await self.database.get_history_summary(user_id=user_id, conversation_id=conversation_id)
+            summary = state["summary"] if state else ""
+            until_id = state["until_id"] if state else None
+
+            for i in range(SUMMARY_MAX_BATCHES):
+                batch = await self.database.get_messages_since(user_id=user_id, conversation_id=conversation_id,
+                                                               after_id=until_id, before_id=before_id, limit=SUMMARY_PAGE_MESSAGES)
+                if i == 0 and len(batch) < SUMMARY_PAGE_MESSAGES and self.count_tokens([message for _, message in batch]) < SUMMARY_TRIGGER_TOKENS:
+                    break
+                batch = self.fit(batch)
+                if not batch:
+                    break
+
+                async with self.semaphore:
+                    summary = await self.summary_chain.ainvoke({
+                        "summary": summary or "None",
+                        "chat_history": [message for _, message in batch],
+                    })
+                until_id = batch[-1][0]
+                await self.database.store_history_summary(user_id=user_id, conversation_id=conversation_id,
+                                                          summary=summary, until_id=until_id)
+                logging.info(f"Summarized {len(batch)} older messages for user {user_id}")
+        except Exception as e:
+            logging.error(f"Error summarizing chat history for user {user_id}: {e}")
+
+    def get_session_history(self, user_id: int, conversation_id: int):
+        # History factory for RunnableWithMessageHistory
+        return Windowed_Chat_History(self, self.database.get_by_session_id(user_id, conversation_id), user_id, conversation_id)
+
+
+class Windowed_Chat_History(chat_database.Async_Only_History):
+    """
+    Chat history whose reads go through a History_window; writes go to the underlying history.
+    Async-only, like the Async_Chat_History it wraps.
+    """
+    def __init__(self, window: History_window, history, user_id: int, conversation_id: int):
+        self.window = window
+        self.history = history
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        return await self.window.load(self.user_id, self.conversation_id)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        await self.history.aadd_messages(messages)
+
+    async def aclear(self) -> None:
+        await self.history.aclear()
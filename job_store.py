@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import pickle
+
+from apscheduler.job import Job
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.util import datetime_to_utc_timestamp
+from bson.binary import Binary
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+class Async_Job_Store(MemoryJobStore):
+    """
+    APScheduler job store that serves every read from memory and mirrors each change to a MongoDB
+    collection of an AsyncMongoClient, so the scheduler never blocks the event loop.
+    Documents have the same layout as MongoDBJobStore's. Await load() before the scheduler starts,
+    and flush() before shutting down.
+    """
+    def __init__(self, collection, pickle_protocol: int = pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+
+        self.collection = collection
+        self.pickle_protocol = pickle_protocol
+
+        self.loaded = [] # Job states read by load(), restored once the scheduler starts the store
+        self.last_write = None
+
+    async def load(self):
+        self.loaded = [document async for document in self.collection.find()]
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+
+        for document in self.loaded:
+            try:
+                job = Job.__new__(Job)
+                job.__setstate__(pickle.loads(document["job_state"]))
+                job._scheduler = scheduler
+                job._jobstore_alias = alias
+            except Exception as e:
+                logging.error(f"Unable to restore scheduled job {document['_id']}, removing it: {e}")
+                self._write(self.collection.delete_one, {"_id": document["_id"]})
+                continue
+            super().add_job(job)
+        self.loaded = []
+
+    def _document(self, job):
+        return {
+            "_id": job.id,
+            "next_run_time": datetime_to_utc_timestamp(job.next_run_time),
+            "job_state": Binary(pickle.dumps(job.__getstate__(), self.pickle_protocol)),
+        }
+
+    def _write(self, operation, *args, **kwargs):
+        # Writes are chained so that they reach MongoDB in the order the scheduler made them
+        previous = self.last_write
+
+        async def write():
+            if previous != None:
+                await asyncio.wait([previous])
+            try:
+                await operation(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"Error saving scheduled jobs: {e}")
+
+        self.last_write = asyncio.get_running_loop().create_task(write())
+
+    async def flush(self):
+        if self.last_write != None:
+            await asyncio.wait([self.last_write])
+
+    def add_job(self, job):
+        super().add_job(job)
+        self._write(self.collection.replace_one, {"_id": job.id}, self._document(job), upsert=True)
+
+    def update_job(self, job):
+        super().update_job(job)
+        self._write(self.collection.replace_one, {"_id": job.id}, self._document(job), upsert=True)
+
+    def remove_job(self, job_id):
+        super().remove_job(job_id)
+        self._write(self.collection.delete_one, {"_id": job_id})
+
+    def remove_all_jobs(self):
+        super().remove_all_jobs()
+        self._write(self.collection.delete_many, {})
+
+    def shutdown(self):
+        # Only forget the jobs in memory; the persisted ones are restored on the next start
+        super().remove_all_jobs()
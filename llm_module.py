@@ -1,5 +1,7 @@
 # importing os module for environment variables
 import os
+import asyncio
+import weakref
 # importing necessary functions from dotenv library
 from dotenv import load_dotenv, dotenv_values 
 
@@ -11,6 +13,8 @@ import chat_database
 
 
 import logging
+from datetime import datetime
+import history_window
 import analysis_module
 import misconception_module
 import teach_module
@@ -25,8 +29,14 @@ MONGO_URI = os.environ.get('MONGO_URI')
 database_name = 'telegram_bot_db'
 chat_collection_name = 'chat_history'
 
+# Maximum number of LLM calls allowed in flight at the same time
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 16))
+
+# Messages folded into the incremental analysis per LLM call
+ANALYSIS_BATCH_MESSAGES = int(os.environ.get('ANALYSIS_BATCH_MESSAGES', 200))
+
 class LLM:
-    def __init__(self, LLM = None, Chat_Database = None):
+    def __init__(self, LLM = None, Chat_Database = None, max_concurrency: int = None):
 
 
         if LLM == None:
@@ -35,19 +45,33 @@ class LLM:
             self.llm = LLM
 
         if Chat_Database == None:
-            self.chat_database = chat_database.Chat_DB()
+            self.chat_database = chat_database.Async_Chat_DB()
         else:
             self.chat_database = Chat_Database
 
+        if max_concurrency == None:
+            max_concurrency = LLM_MAX_CONCURRENCY
+
+        # Caps the number of concurrent calls so a burst of users cannot exhaust the API rate limit
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        # Per-user locks for incremental misconception tracking; entries go away once no run holds them
+        self.misconception_locks = weakref.WeakValueDictionary()
+        # Same for the incremental learning style analysis
+        self.analysis_locks = weakref.WeakValueDictionary()
+
+        # Token-budgeted history shared by every chain
+        self.history = history_window.History_window(llm=self.llm, database=self.chat_database, semaphore=self.semaphore)
+
         self.analyse = analysis_module.Analyser(self.llm)
         self.misconception = misconception_module.Misconception(self.llm)
-        self.teach = teach_module.Teacher(llm=self.llm, database=self.chat_database)
-        self.initiator = daily_initiator.DailyConversationInitiator(llm=self.llm, database=self.chat_database)
+        self.teach = teach_module.Teacher(llm=self.llm, database=self.chat_database, history=self.history)
+        self.initiator = daily_initiator.DailyConversationInitiator(llm=self.llm, database=self.chat_database, history=self.history)
 
     # Response to assignment classification
     async def assignment_message(self, message : str):
 
-        list_assignments = self.chat_database.get_assignments()
+        list_assignments = await self.chat_database.get_assignments()
 
         assignment_name = await self.assignment.get_assignment(message=message,
                                                                 list_assignments=list_assignments)
@@ -59,41 +83,120 @@ class LLM:
     # Response to analysis request
     async def analyse_message(self, user_id : str):
 
-        messages = self.chat_database.get_all_conversation(user_id=user_id)
+        # Runs for the same user (e.g. a double tap, or an admin's /analyse <id>) must not overlap, or
+        # both would fold the same batch into the state
+        lock = self.analysis_locks.setdefault(int(user_id), asyncio.Lock())
+        async with lock:
+            # Only messages newer than the stored checkpoint are sent, together with the previous state
+            state = await self.chat_database.get_learning_style_state(user_id=user_id)
+            last_message_id = state.get("last_message_id") if state else None
+
+            while True:
+                fetched = await self.chat_database.get_messages_since(user_id=user_id, after_id=last_message_id,
+                                                                     limit=ANALYSIS_BATCH_MESSAGES)
+                # Messages beyond the token budget are left for the next batch
+                batch = self.history.fit(fetched)
+                if not batch:
+                    break
+
+                async with self.semaphore:
+                    update = await self.analyse.update_analysis(state=state, messages=[message for _, message in batch])
+
+                last_message_id = batch[-1][0]
+                state = dict(update, last_message_id=last_message_id, updated=datetime.now(),
+                             message_count=(state.get("message_count", 0) if state else 0) + len(batch))
+                # Checkpoint after every batch so a long backlog is never re-sent
+                await self.chat_database.store_learning_style_state(user_id=user_id, state=state)
+
+                if len(fetched) < ANALYSIS_BATCH_MESSAGES and len(batch) == len(fetched):
+                    break
+
+        if not state:
+            return self.analyse.no_history_report()
+
+        response = state["report"]
 
-        response = await self.analyse.get_analysis(messages=messages)
-        
         logging.info(f"Analysis report: {response}")
         
         return response
     
-    async def analyse_all_message(self, user_id: str):
-        messages = self.chat_database.get_all_conversation(user_id=user_id)
-        report = await self.analyse.get_analysis_all(messages=messages)
+    async def analyse_all_message(self, user_id: str, messages: list = None):
+        # Callers that already loaded the history pass it in to avoid a second read
+        if messages == None:
+            messages = await self.chat_database.get_all_conversation(user_id=user_id)
+        async with self.semaphore:
+            report = await self.analyse.get_analysis_all(messages=messages)
         logging.info(f"Comprehensive analysis for user {user_id}: {report}")
         return report
     
     # Response to misconception request
     async def misconception_message(self, user_id : str):
 
-        messages = self.chat_database.get_all_conversation(user_id=user_id)
-        response = await self.misconception.get_misconception(messages=messages)
+        findings = await self.update_misconceptions(user_id=user_id)
+        has_history = bool(findings) or await self.chat_database.get_misconception_checkpoint(user_id=user_id) != None
+
+        response = self.misconception.format_report(findings, has_history=has_history)
         logging.info(f"Misconception report: {response}")
         
         return response
 
+    async def update_misconceptions(self, user_id : str):
+        """
+        Analyses only the messages since the user's misconception checkpoint and merges the findings
+        into the stored ones. Returns every stored finding for the user.
+        """
+        # Runs for the same user (e.g. after /new and an explicit /uncover) must not overlap
+        lock = self.misconception_locks.setdefault(int(user_id), asyncio.Lock())
+        async with lock:
+            findings = await self.chat_database.get_misconceptions(user_id=user_id)
+            last_message_id = await self.chat_database.get_misconception_checkpoint(user_id=user_id)
+
+            while True:
+                fetched = await self.chat_database.get_messages_since(user_id=user_id, after_id=last_message_id,
+                                                                     limit=ANALYSIS_BATCH_MESSAGES)
+                # Messages beyond the token budget are left for the next batch
+                batch = self.history.fit(fetched)
+                if not batch:
+                    break
+
+                async with self.semaphore:
+                    new_findings = await self.misconception.detect_misconceptions(known=findings, messages=[message for _, message in batch])
+
+                last_message_id = batch[-1][0]
+                await self.chat_database.store_misconceptions(user_id=user_id, findings=new_findings,
+                                                              first_message_id=batch[0][0], last_message_id=last_message_id)
+                findings = await self.chat_database.get_misconceptions(user_id=user_id)
+
+                if len(fetched) < ANALYSIS_BATCH_MESSAGES and len(batch) == len(fetched):
+                    break
+
+        return findings
+
     # Response to text message    
     async def response_message(self, message: str, user_id : str, conversation_id: str, user_context: str):
 
-        response = await self.teach.get_response(message=message, user_id=user_id, 
-                                                         conversation_id=conversation_id, user_context = user_context)
+        async with self.semaphore:
+            response = await self.teach.get_response(message=message, user_id=user_id, 
+                                                     conversation_id=conversation_id, user_context = user_context)
         logging.info(f"Teaching: {response}")
 
         return response
+
+    # Streamed response to text message
+    async def stream_response_message(self, message: str, user_id : str, conversation_id: str, user_context: str):
+
+        chunks = []
+        async with self.semaphore:
+            async for chunk in self.teach.stream_response(message=message, user_id=user_id,
+                                                          conversation_id=conversation_id, user_context = user_context):
+                chunks.append(chunk)
+                yield chunk
+        logging.info(f"Teaching: {''.join(chunks)}")
     
     async def starter_message(self, user_id: str):
 
-        response = await self.initiator.initiate_conversation(user_id=user_id)
+        async with self.semaphore:
+            response = await self.initiator.initiate_conversation(user_id=user_id)
 
         logging.info(f"Starter: {response}")
 
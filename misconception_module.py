@@ -1,6 +1,53 @@
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from datetime import datetime
+import json
+
+
+def _as_text(value):
+    if value == None:
+        return ""
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+
+def _as_bool(value):
+    # Only an explicit true counts; bool("false") would be True
+    if isinstance(value, bool):
+        return value
+    return isinstance(value, str) and value.strip().lower() == "true"
+
+
+def normalize_findings(response):
+    """
+    The findings of an LLM response in the shape store_misconceptions writes: entries that are not
+    objects or have no topic are dropped, text fields are strings, examples a list of strings and
+    resolved a real boolean.
+    """
+    findings = response.get("misconceptions") if isinstance(response, dict) else None
+    if not isinstance(findings, list):
+        return []
+
+    normalized = []
+    for finding in findings:
+        if not isinstance(finding, dict):
+            continue
+        topic = _as_text(finding.get("topic")).strip()
+        if not topic:
+            continue
+        examples = finding.get("examples")
+        if examples == None:
+            examples = []
+        elif not isinstance(examples, list):
+            examples = [examples]
+        normalized.append({
+            "topic": topic,
+            "description": _as_text(finding.get("description")),
+            "examples": [_as_text(example) for example in examples if example not in (None, "")],
+            "correction": _as_text(finding.get("correction")),
+            "recommendations": _as_text(finding.get("recommendations")),
+            "resolved": _as_bool(finding.get("resolved")),
+        })
+    return normalized
 
 
 class Misconception:
@@ -75,8 +122,79 @@ class Misconception:
 
         self.misconception_chain = self.misconception_prompt | self.llm | StrOutputParser()
 
+        # Incremental detection: only new messages are analysed, with the topics already on record
+        self.incremental_system_prompt = (
+        """
+        You are an AI tracking the **misconceptions** a user has, based on their chat history with an educational chatbot. Look for misunderstood core concepts, errors in applying theory to practical problems, misconceptions about best practices, and flawed reasoning or incorrect assumptions.
+
+        You are given the misconceptions already on record for this user and only the messages sent since they were recorded.
+        Report every misconception shown in the new messages. When it matches a topic on record, reuse that topic name exactly, and set "resolved" to true if the new messages show the user now understands it.
+        Do not repeat topics on record that the new messages say nothing about.
+
+        Respond with a single JSON object and nothing else, in this format:
+        {{
+            "misconceptions": [
+                {{
+                    "topic": "<short topic name, e.g. Probability in Statistics>",
+                    "description": "<brief description of the misunderstanding>",
+                    "examples": ["<short quote or paraphrase from the new messages>"],
+                    "correction": "<clear explanation that corrects the misunderstanding>",
+                    "recommendations": "<specific steps, strategies or resources to improve understanding>",
+                    "resolved": false
+                }}
+            ]
+        }}
+
+        If the new messages show no misconceptions, respond with {{"misconceptions": []}}.
+        Write the text fields in Markdown (`*bold*`, `_italic_`, `` `inline code` ``).
+        """
+        )
+        self.incremental_prompt = ChatPromptTemplate.from_messages([
+            ("system", self.incremental_system_prompt),
+            ("human", "Misconceptions on record: {known}\n\nNew chat messages: {chat_history}\n\nReturn the misconceptions shown in the new messages.")
+        ])
+        self.incremental_chain = self.incremental_prompt | self.llm | JsonOutputParser()
+
     async def get_misconception(self, messages):
 
-        response = self.misconception_chain.invoke({ "datetime": datetime.now().replace(microsecond=0), "chat_history": messages})
+        response = await self.misconception_chain.ainvoke({ "datetime": datetime.now().replace(microsecond=0), "chat_history": messages})
     
         return response
+
+    async def detect_misconceptions(self, known, messages):
+        # known is the list of stored findings; returns the findings for the new messages
+        on_record = [
+            {"topic": finding["topic"], "description": finding.get("description", ""), "resolved": finding.get("resolved", False)}
+            for finding in known
+        ]
+        response = await self.incremental_chain.ainvoke({"known": on_record or "None", "chat_history": messages})
+
+        return normalize_findings(response)
+
+    def format_report(self, findings, has_history: bool = True):
+        # Renders the stored findings without another LLM call
+        now = datetime.now().replace(microsecond=0)
+        if not has_history:
+            return f"*There is no chat history available as of {now}. Therefore, no misconception report can be provided at this time.*"
+
+        report = f"*Here is a misconception report of the chat history between the user and the educational chatbot as of {now}:*\n\n"
+        if not findings:
+            return report + "No misconceptions were found in the chat history so far."
+
+        open_findings = [finding for finding in findings if not finding.get("resolved")]
+        resolved_findings = [finding for finding in findings if finding.get("resolved")]
+
+        for number, finding in enumerate(open_findings, start=1):
+            report += f"*{number}. {finding['topic']}*\n{finding.get('description', '')}\n"
+            if finding.get("examples"):
+                report += "_Examples:_\n" + "".join(f"- {example}\n" for example in finding["examples"])
+            if finding.get("correction"):
+                report += f"_Correction:_ {finding['correction']}\n"
+            if finding.get("recommendations"):
+                report += f"_Recommendations:_ {finding['recommendations']}\n"
+            report += "\n"
+
+        if resolved_findings:
+            report += "*Resolved since earlier conversations:*\n" + "".join(f"- {finding['topic']}\n" for finding in resolved_findings)
+
+        return report
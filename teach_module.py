@@ -1,16 +1,22 @@
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.runnables import ConfigurableFieldSpec
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.messages import AIMessage, HumanMessage
 import StrOutputParserWithAnswer
+import history_window
 
 
 class Teacher:
 
-    def __init__(self, llm, database):
+    def __init__(self, llm, database, history = None):
 
         self.llm = llm
         self.database = database
 
+        # Loads the recent turns that fit the token budget, with older turns summarized
+        self.history = history if history != None else history_window.History_window(llm=llm, database=database)
+
         self.teaching_prompt = (
     """
     You are METABot, an AI-powered **Educational Assistant** hosted on Telegram, designed to help learners across various subjects and disciplines. Your primary role is to provide explanations, guide problem-solving, and support students in their educational journey. You cater to different levels of learners, from beginners to advanced, ensuring that responses are clear, concise, and engaging.
@@ -103,20 +109,24 @@ class Teacher:
         self.prompt = ChatPromptTemplate.from_messages(
             [
                 ("system", self.teaching_prompt),
-                MessagesPlaceholder("chat_history", n_messages=10),
+                MessagesPlaceholder("chat_history"),
                 ("human", "Context: {context} \n\n Prompt: {input}"),
             ]
         )
 
         
         self.question_answer_chain = self.prompt | self.llm | StrOutputParserWithAnswer.StrOutputParserWithAnswer()
+
+        # Same prompt, but yields plain text chunks for streaming replies
+        self.stream_chain = self.prompt | self.llm | StrOutputParser()
         
     async def get_response(self, message: str, user_id : str, conversation_id: str, user_context:str):
 
 
+        # Built per call and only run with ainvoke: the session histories are async-only
         conversational_rag_chain = RunnableWithMessageHistory(
             self.question_answer_chain,
-            self.database.get_by_session_id,
+            self.history.get_session_history,
             input_messages_key="input",
             history_messages_key="chat_history",
             output_messages_key="answer",
@@ -145,6 +155,22 @@ class Teacher:
             "configurable": {"user_id": user_id , "conversation_id": conversation_id}
         }
 
-        response = conversational_rag_chain.invoke({"input": message, "context":user_context}, config=config)
+        response = await conversational_rag_chain.ainvoke({"input": message, "context":user_context}, config=config)
         
-        return response['answer']
\ No newline at end of file
+        return response['answer']
+
+    async def stream_response(self, message: str, user_id : str, conversation_id: str, user_context:str):
+        """
+        Yields the answer as text chunks while the LLM generates it.
+        The exchange is written to the chat history once, after the answer completes.
+        """
+
+        history = self.database.get_by_session_id(user_id, conversation_id)
+        chat_history = await self.history.load(user_id, conversation_id)
+
+        chunks = []
+        async for chunk in self.stream_chain.astream({"input": message, "context": user_context, "chat_history": chat_history}):
+            chunks.append(chunk)
+            yield chunk
+
+        await history.aadd_messages([HumanMessage(content=message), AIMessage(content="".join(chunks))])
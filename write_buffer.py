@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+class Write_buffer:
+    """
+    Write-behind buffer: collects items and hands them to the coroutine function flush(items) in
+    batches, once max_size items are waiting or interval seconds after the first one arrived.
+    A failed batch is kept and retried after interval seconds; call flush() before shutting down.
+    """
+    def __init__(self, flush, max_size: int = 500, interval: float = 1.0, name: str = "write buffer"):
+
+        self.write = flush
+        self.max_size = max_size
+        self.interval = interval
+        self.name = name
+
+        self.items = []
+        self.lock = asyncio.Lock()
+        self.timer = None
+
+    def __len__(self):
+        return len(self.items)
+
+    async def add(self, item):
+        self.items.append(item)
+        if len(self.items) >= self.max_size:
+            await self.flush()
+        elif self.timer == None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        # Returns False if the batch could not be written; it stays buffered and is retried
+        if self.timer != None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+            self.timer = None
+
+        async with self.lock:
+            items, self.items = self.items, []
+            if not items:
+                return True
+
+            try:
+                await self.write(items)
+            except Exception as e:
+                logging.error(f"Error flushing {len(items)} item(s) from {self.name}: {e}")
+                self.items[:0] = items
+                if self.timer == None:
+                    self.timer = asyncio.create_task(self._flush_later())
+                return False
+
+            logging.info(f"Flushed {len(items)} item(s) from {self.name}")
+            return True